@@ -0,0 +1,212 @@
+#!/usr/bin/python
+"""
+Generate:
+---------
+
+Generates synthetic FAOSTAT bulk files for benchmarking. Files have the
+schema of the normalized FS bulk CSV (optionally with the Months columns of
+monthly indicator sets like CP), are encoded WINDOWS-1252 with every data
+field quoted and \r\n line endings, and are sorted by area code like the real
+files. Area codes and names come from the FAOSTAT country groups file so that
+get_countries maps them to countries.
+
+"""
+
+import argparse
+import csv
+import logging
+import random
+from os.path import basename, getsize, join
+from zipfile import ZIP_DEFLATED, ZipFile
+
+logger = logging.getLogger(__name__)
+
+countries_path = join(
+    "src", "hdx", "scraper", "faostat", "config", "FAOSTAT_CountryGroups.csv"
+)
+fieldnames = [
+    "Area Code",
+    "Area",
+    "Item Code",
+    "Item",
+    "Element Code",
+    "Element",
+    "Year Code",
+    "Year",
+    "Unit",
+    "Value",
+    "Flag",
+]
+months_fieldnames = ["Months Code", "Months"]
+month_names = [
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+]
+
+
+def get_areas(number, countries_path=countries_path):
+    """Get area codes and names, taken from the country groups file in area
+    code order with made up regional aggregates added if more are needed.
+
+    Args:
+        number: Number of areas
+        countries_path: Path to FAOSTAT country groups file
+
+    Returns:
+        List of (area code, area name)
+    """
+    areas = {}
+    with open(countries_path, encoding="utf-8") as f:
+        for row in csv.DictReader(f, skipinitialspace=True):
+            row = {key.strip(): value.strip() for key, value in row.items()}
+            areas[row["Country Code"]] = row["Country"]
+    areas = sorted(areas.items(), key=lambda x: int(x[0]))[:number]
+    for i in range(number - len(areas)):
+        areas.append((str(5000 + i), f"Region {i + 1}"))
+    return areas
+
+
+def generate_rows(
+    rows,
+    areas,
+    items=20,
+    elements=3,
+    start_year=2000,
+    end_year=2022,
+    months=False,
+    monthly_share=0.5,
+    range_share=0.3,
+    seed=0,
+):
+    """Generate rows of a bulk CSV. Rows are spread evenly across areas and
+    within each area cycle through items, elements and years (and months for
+    a share of items if months is True). A share of items have three year
+    ranges like 1999-2001 instead of single years.
+
+    Args:
+        rows: Number of rows
+        areas: List of (area code, area name)
+        items: Number of items. Defaults to 20.
+        elements: Number of elements per item. Defaults to 3.
+        start_year: First year. Defaults to 2000.
+        end_year: Last year. Defaults to 2022.
+        months: Whether to include Months columns. Defaults to False.
+        monthly_share: Share of items that are monthly if months is True. Defaults to 0.5.
+        range_share: Share of items with year ranges. Defaults to 0.3.
+        seed: Random seed. Defaults to 0.
+
+    Returns:
+        Iterator of lists of field values
+    """
+    rng = random.Random(seed)
+    periods = []
+    for year in range(start_year, end_year + 1):
+        periods.append((str(year), str(year), None))
+    range_periods = []
+    for year in range(start_year, end_year - 1):
+        range_periods.append((f"{year}{year + 2}", f"{year}-{year + 2}", None))
+    monthly_periods = []
+    for year in range(start_year, end_year + 1):
+        for month, name in enumerate(month_names, start=1):
+            monthly_periods.append((str(year), str(year), (str(7000 + month), name)))
+    item_periods = []
+    for item in range(items):
+        if months and rng.random() < monthly_share:
+            item_periods.append(monthly_periods)
+        elif rng.random() < range_share:
+            item_periods.append(range_periods)
+        else:
+            item_periods.append(periods)
+    nareas = len(areas)
+    for i, (area_code, area_name) in enumerate(areas):
+        area_rows = rows // nareas + (1 if i < rows % nareas else 0)
+        row_number = 0
+        while row_number < area_rows:
+            for item in range(items):
+                for element in range(elements):
+                    for year_code, year, month in item_periods[item]:
+                        if row_number == area_rows:
+                            break
+                        row = [
+                            area_code,
+                            area_name,
+                            str(21000 + item),
+                            f"Item {item + 1} (percent)",
+                            str(6100 + element),
+                            f"Element {element + 1}",
+                            year_code,
+                            year,
+                        ]
+                        if months:
+                            if month is None:
+                                row.extend(("7021", "Annual value"))
+                            else:
+                                row.extend(month)
+                        row.extend(("%", f"{rng.uniform(0, 1000):.2f}", "E"))
+                        yield row
+                        row_number += 1
+
+
+def write_bulk_csv(path, rows, areas, months=False, **kwargs):
+    """Write a synthetic bulk CSV.
+
+    Args:
+        path: Path of CSV file
+        rows: Number of rows
+        areas: List of (area code, area name)
+        months: Whether to include Months columns. Defaults to False.
+        **kwargs: Other arguments to pass to generate_rows
+
+    Returns:
+        Number of bytes written
+    """
+    header = list(fieldnames)
+    if months:
+        header[8:8] = months_fieldnames
+    with open(path, "w", encoding="WINDOWS-1252", newline="") as f:
+        f.write(f"{','.join(header)}\r\n")
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator="\r\n")
+        writer.writerows(generate_rows(rows, areas, months=months, **kwargs))
+    return getsize(path)
+
+
+def write_bulk_zip(zip_path, member, csv_path):
+    with ZipFile(zip_path, "w", compression=ZIP_DEFLATED) as z:
+        z.write(csv_path, member)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic bulk file")
+    parser.add_argument("path", help="Path of CSV file (or zip if ending in .zip)")
+    parser.add_argument("--rows", type=int, default=1000000, help="Number of rows")
+    parser.add_argument("--areas", type=int, default=250, help="Number of areas")
+    parser.add_argument("--months", action="store_true", help="Add Months columns")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+    areas = get_areas(args.areas)
+    if args.path.endswith(".zip"):
+        csv_path = f"{args.path.removesuffix('.zip')}.csv"
+    else:
+        csv_path = args.path
+    size = write_bulk_csv(
+        csv_path, args.rows, areas, months=args.months, seed=args.seed
+    )
+    logger.info(f"Wrote {args.rows} rows ({size} bytes) to {csv_path}")
+    if csv_path != args.path:
+        write_bulk_zip(args.path, basename(csv_path), csv_path)
+        logger.info(f"Zipped {csv_path} to {args.path}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
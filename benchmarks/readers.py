@@ -0,0 +1,104 @@
+#!/usr/bin/python
+"""
+Readers:
+--------
+
+Compares generating datasets from the split files of a bulk zip, by default
+the FS test fixture, when the split files are read with get_tabular_rows and
+with read_split_rows. Each reader is run as a stage of the benchmark harness
+and the resource files they write are checked to be the same.
+
+    python -m benchmarks.readers
+    python -m benchmarks.readers --zip FS.zip --countries 50
+
+"""
+
+import argparse
+import filecmp
+import logging
+from os import listdir, makedirs
+from os.path import join
+from tempfile import TemporaryDirectory
+
+from benchmarks.run import category, generate_stage, get_countries_stage, run_stage
+
+logger = logging.getLogger(__name__)
+
+fixture_path = join("tests", "fixtures", "FS.zip")
+fixture_member = "Food_Security_Data_E_All_Data_(Normalized).csv"
+
+
+def compare_readers(workdir, zip_path, member, countries=None):
+    """Split member of zip_path by country and benchmark generating datasets
+    from the splits with each reader.
+
+    Args:
+        workdir: Folder in which to write files
+        zip_path: Path of bulk zip
+        member: Name of bulk CSV in zip
+        countries: Number of countries for which to generate datasets. Defaults to None (all).
+
+    Returns:
+        Dictionary of results by stage
+    """
+    from hdx.scraper.faostat.pipeline import split_zip_member_by_country
+
+    split_dir = join(workdir, "split")
+    makedirs(split_dir)
+    areas = split_zip_member_by_country(zip_path, member, split_dir)
+    _, (country_list, countrymapping) = run_stage(
+        "get_countries", get_countries_stage, join(workdir, "countries")
+    )
+    country_list = [x for x in country_list if x["countrycode"] in areas]
+    if countries:
+        country_list = country_list[:countries]
+    row = {
+        "DatasetCode": "FS",
+        "DatasetName": f"{category}: Suite of Food Security Indicators",
+        "DatasetDescription": "Benchmark data.",
+        "split_dir": split_dir,
+        "areas": areas,
+    }
+    stages = {}
+    folders = {}
+    for name, local_reader in (("get_tabular_rows", False), ("read_split_rows", True)):
+        folders[name] = join(workdir, name)
+        stages[name], _ = run_stage(
+            name,
+            generate_stage,
+            folders[name],
+            {category: [row]},
+            country_list,
+            countrymapping,
+            local_reader,
+        )
+    filenames = sorted(listdir(folders["get_tabular_rows"]))
+    _, mismatch, errors = filecmp.cmpfiles(
+        folders["get_tabular_rows"], folders["read_split_rows"], filenames, False
+    )
+    if mismatch or errors:
+        raise ValueError(f"Readers wrote different files: {mismatch + errors}")
+    speedup = (
+        stages["get_tabular_rows"]["seconds"] / stages["read_split_rows"]["seconds"]
+    )
+    logger.info(f"read_split_rows is {speedup:.1f}x as fast as get_tabular_rows")
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark readers of split files when generating datasets"
+    )
+    parser.add_argument("--zip", default=fixture_path, help="Path of bulk zip")
+    parser.add_argument("--member", default=fixture_member, help="Bulk CSV in zip")
+    parser.add_argument(
+        "--countries", type=int, help="Countries to generate datasets for"
+    )
+    args = parser.parse_args()
+    with TemporaryDirectory(prefix="faostat-benchmark-readers") as workdir:
+        compare_readers(workdir, args.zip, args.member, args.countries)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    main()
@@ -0,0 +1,351 @@
+#!/usr/bin/python
+"""
+Run:
+----
+
+Benchmarks the main stages of the scraper against a synthetic bulk file,
+reporting rows per second, peak RSS and the temporary disk space used by each
+stage. Each stage runs in its own process so that peak RSS is its own. The
+results are saved as JSON and can be compared with those of an earlier run to
+catch regressions.
+
+    python -m benchmarks.run --rows 1000000 --output results.json
+    python -m benchmarks.run --baseline results.json
+
+"""
+
+import argparse
+import json
+import logging
+import platform
+import resource
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import UTC, datetime
+from importlib.metadata import PackageNotFoundError, version
+from multiprocessing import get_context
+from os import makedirs
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import perf_counter
+
+from benchmarks.generate import countries_path, get_areas, write_bulk_csv
+from hdx.scraper.faostat.metrics import get_disk_usage
+
+logger = logging.getLogger(__name__)
+
+project_config_yaml = join(
+    "src", "hdx", "scraper", "faostat", "config", "project_configuration.yaml"
+)
+category = "Food Security and Nutrition"
+min_seconds = 0.01
+
+
+def _sample_disk_usage(path, stop, peak):
+    while not stop.wait(0.05):
+        peak[0] = max(peak[0], get_disk_usage(path))
+
+
+def _measure(function, workdir, *args):
+    # Runs in a child process. The stage function returns the number of rows
+    # it processed, the seconds taken by the part being benchmarked (leaving
+    # out any setup) and a result to hand to later stages.
+    makedirs(workdir, exist_ok=True)
+    stop = Event()
+    peak = [0]
+    sampler = Thread(target=_sample_disk_usage, args=(workdir, stop, peak))
+    sampler.start()
+    try:
+        rows, seconds, result = function(workdir, *args)
+    finally:
+        stop.set()
+        sampler.join()
+    peak[0] = max(peak[0], get_disk_usage(workdir))
+    metrics = {
+        "rows": rows,
+        "seconds": round(seconds, 4),
+        "rows_per_second": round(rows / seconds) if seconds else None,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "temp_disk_bytes": peak[0],
+    }
+    return metrics, result
+
+
+def run_stage(name, function, workdir, *args):
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+        metrics, result = pool.submit(_measure, function, workdir, *args).result()
+    logger.info(
+        f"{name}: {metrics['rows']} rows in {metrics['seconds']}s ({metrics['rows_per_second']} rows/s), peak RSS {metrics['peak_rss_bytes']} bytes, temp disk {metrics['temp_disk_bytes']} bytes"
+    )
+    return metrics, result
+
+
+def split_stage(split_dir, csv_path, split_options):
+    from hdx.scraper.faostat.pipeline import split_csv_by_country
+
+    start = perf_counter()
+    areas = split_csv_by_country(csv_path, split_dir, **split_options)
+    seconds = perf_counter() - start
+    return sum(x["rows"] for x in areas.values()), seconds, areas
+
+
+def log_latest_dates_stage(workdir, indicatorsets, countrycodes, rows):
+    from hdx.scraper.faostat.pipeline import log_latest_dates
+
+    start = perf_counter()
+    log_latest_dates(indicatorsets, countrycodes)
+    return rows, perf_counter() - start, None
+
+
+def _get_retriever(downloader, folder):
+    from hdx.utilities.retriever import Retrieve
+
+    return Retrieve(
+        downloader=downloader,
+        fallback_dir=folder,
+        saved_dir=folder,
+        temp_dir=folder,
+        save=False,
+        use_saved=False,
+    )
+
+
+def get_countries_stage(workdir):
+    from hdx.location.country import Country
+    from hdx.utilities.downloader import Download
+
+    from hdx.scraper.faostat.pipeline import get_countries
+
+    Country.countriesdata(use_live=False)
+    with open(countries_path, encoding="utf-8") as f:
+        rows = sum(1 for _ in f) - 1
+    with Download(user_agent="benchmark") as downloader:
+        retriever = _get_retriever(downloader, workdir)
+        start = perf_counter()
+        countries, countrymapping = get_countries(countries_path, retriever)
+        seconds = perf_counter() - start
+    return rows, seconds, (countries, countrymapping)
+
+
+def generate_stage(
+    folder, indicatorsets, countries, countrymapping, local_reader=False
+):
+    from hdx.api.configuration import Configuration
+    from hdx.api.locations import Locations
+    from hdx.data.resource import Resource
+    from hdx.data.vocabulary import Vocabulary
+    from hdx.location.country import Country
+    from hdx.utilities.downloader import Download
+
+    from hdx.scraper.faostat.pipeline import generate_dataset_and_showcase
+
+    # Read only HDX configuration with the lookups that would otherwise be
+    # downloaded set up locally
+    Configuration._create(
+        hdx_read_only=True,
+        user_agent="benchmark",
+        project_config_yaml=project_config_yaml,
+    )
+    configuration = Configuration.read()
+    Country.countriesdata(use_live=False)
+    Locations.set_validlocations(
+        [{"name": x["iso3"].lower(), "title": x["countryname"]} for x in countries]
+    )
+    tags = configuration["categories"][category]["tags"]
+    Vocabulary.set_tagsdict({x: {"Action to Take": "ok"} for x in tags})
+    Vocabulary._approved_vocabulary = {
+        "tags": [{"name": x} for x in tags],
+        "id": "benchmark",
+        "name": "approved",
+    }
+    Resource.set_formatsdict({"csv": "csv"})
+    areas = indicatorsets[category][0]["areas"]
+    rows = sum(areas[x["countrycode"]]["rows"] for x in countries)
+    with Download(user_agent="benchmark") as downloader:
+        retriever = _get_retriever(downloader, folder)
+        start = perf_counter()
+        for country in countries:
+            generate_dataset_and_showcase(
+                category,
+                configuration["categories"],
+                indicatorsets,
+                country,
+                countrymapping,
+                configuration["showcase_base_url"],
+                configuration["filelist_url"],
+                retriever,
+                folder,
+                local_reader=local_reader,
+            )
+        seconds = perf_counter() - start
+    return rows, seconds, None
+
+
+def run_benchmarks(workdir, rows, areas, months=False, countries=10, seed=0):
+    """Generate a synthetic bulk file in workdir and benchmark the stages of
+    the scraper on it.
+
+    Args:
+        workdir: Folder in which to write files
+        rows: Number of rows in bulk file
+        areas: Number of areas in bulk file
+        months: Whether bulk file has Months columns. Defaults to False.
+        countries: Number of countries for which to generate datasets. Defaults to 10.
+        seed: Random seed. Defaults to 0.
+
+    Returns:
+        Dictionary of results
+    """
+    csv_path = join(workdir, "FS.csv")
+    size = write_bulk_csv(csv_path, rows, get_areas(areas), months=months, seed=seed)
+    stages = {}
+    stages["split_csv_by_country"], split_areas = run_stage(
+        "split_csv_by_country", split_stage, join(workdir, "split"), csv_path, {}
+    )
+    stages["split_csv_by_country_fast"], _ = run_stage(
+        "split_csv_by_country_fast",
+        split_stage,
+        join(workdir, "split_fast"),
+        csv_path,
+        {"fast": True},
+    )
+    stages["get_countries"], (country_list, countrymapping) = run_stage(
+        "get_countries", get_countries_stage, join(workdir, "countries")
+    )
+    country_list = [x for x in country_list if x["countrycode"] in split_areas]
+    countrycodes = [x["countrycode"] for x in country_list]
+    row = {
+        "DatasetCode": "FS",
+        "DatasetName": f"{category}: Suite of Food Security Indicators",
+        "DatasetDescription": "Synthetic benchmark data.",
+        "split_dir": join(workdir, "split"),
+        "areas": split_areas,
+    }
+    stages["log_latest_dates"], _ = run_stage(
+        "log_latest_dates",
+        log_latest_dates_stage,
+        join(workdir, "latest"),
+        {category: [row]},
+        countrycodes,
+        rows,
+    )
+    stages["log_latest_dates_scan"], _ = run_stage(
+        "log_latest_dates_scan",
+        log_latest_dates_stage,
+        join(workdir, "latest_scan"),
+        {category: [{"DatasetCode": "FS", "path": csv_path}]},
+        countrycodes,
+        rows,
+    )
+    stages["generate_dataset_and_showcase"], _ = run_stage(
+        "generate_dataset_and_showcase",
+        generate_stage,
+        join(workdir, "generate"),
+        {category: [row]},
+        country_list[:countries],
+        countrymapping,
+    )
+    stages["generate_dataset_and_showcase_local_reader"], _ = run_stage(
+        "generate_dataset_and_showcase_local_reader",
+        generate_stage,
+        join(workdir, "generate_local_reader"),
+        {category: [row]},
+        country_list[:countries],
+        countrymapping,
+        True,
+    )
+    try:
+        package_version = version("hdx-scraper-faostat")
+    except PackageNotFoundError:
+        package_version = None
+    return {
+        "created": datetime.now(UTC).isoformat(timespec="seconds"),
+        "version": package_version,
+        "python": platform.python_version(),
+        "parameters": {
+            "rows": rows,
+            "areas": areas,
+            "months": months,
+            "countries": countries,
+            "seed": seed,
+        },
+        "csv_bytes": size,
+        "stages": stages,
+    }
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """Compare rows per second of each stage with those of a baseline run.
+
+    Args:
+        results: Results of this run
+        baseline: Results of an earlier run
+        tolerance: Fraction slower than the baseline allowed. Defaults to 0.2.
+
+    Returns:
+        List of stages that are slower than the baseline by more than tolerance
+    """
+    regressions = []
+    for name, metrics in results["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if not base or not base["rows_per_second"] or not metrics["rows_per_second"]:
+            continue
+        if min(base["seconds"], metrics["seconds"]) < min_seconds:
+            # Too quick to time reliably
+            continue
+        change = metrics["rows_per_second"] / base["rows_per_second"] - 1
+        logger.info(f"{name}: {change:+.1%} rows/s compared with baseline")
+        if change < -tolerance:
+            regressions.append(name)
+    if results["parameters"] != baseline.get("parameters"):
+        logger.warning("Baseline was run with different parameters!")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the FAOSTAT scraper")
+    parser.add_argument("--rows", type=int, default=1000000, help="Number of rows")
+    parser.add_argument("--areas", type=int, default=250, help="Number of areas")
+    parser.add_argument("--months", action="store_true", help="Add Months columns")
+    parser.add_argument(
+        "--countries", type=int, default=10, help="Countries to generate datasets for"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--workdir", help="Folder for files (default temporary)")
+    parser.add_argument("--output", help="Path of JSON file in which to save results")
+    parser.add_argument("--baseline", help="Path of JSON results to compare with")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="Allowed slowdown vs baseline"
+    )
+    args = parser.parse_args()
+    kwargs = {
+        "rows": args.rows,
+        "areas": args.areas,
+        "months": args.months,
+        "countries": args.countries,
+        "seed": args.seed,
+    }
+    if args.workdir:
+        makedirs(args.workdir, exist_ok=True)
+        results = run_benchmarks(args.workdir, **kwargs)
+    else:
+        with TemporaryDirectory(prefix="faostat-benchmark") as workdir:
+            results = run_benchmarks(workdir, **kwargs)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Saved results to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions:
+            logger.error(f"Slower than baseline: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    main()
@@ -5,8 +5,11 @@ Top level script. Calls other functions that generate datasets that this script
 """
 
 import logging
-from os.path import exists, expanduser, join
+from contextlib import nullcontext
+from os import getenv, makedirs, unlink
+from os.path import dirname, exists, expanduser, join, splitext
 from shutil import rmtree
+from threading import Lock
 
 from hdx.api.configuration import Configuration
 from hdx.facades.infer_arguments import facade
@@ -18,90 +21,403 @@ from hdx.utilities.path import (
 )
 from hdx.utilities.retriever import Retrieve
 
+from hdx.scraper.faostat.generate import Generator
+from hdx.scraper.faostat.metrics import Metrics
+from hdx.scraper.faostat.offline import RecordingHDX, setup_offline
 from hdx.scraper.faostat.pipeline import (
     download_indicatorsets,
-    generate_dataset_and_showcase,
     get_countries,
+    get_shard_countries,
+    log_latest_dates,
+)
+from hdx.scraper.faostat.profiling import Profiler
+from hdx.scraper.faostat.publish import Publisher
+from hdx.scraper.faostat.state import (
+    get_publish_hashes,
+    indicatorsets_filename,
+    load_state,
+    published_filename,
+    save_state,
 )
 
 logger = logging.getLogger(__name__)
 
 lookup = "hdx-scraper-faostat"
 _SAVED_DATA_DIR = "saved_data"
+_METRICS_FILENAME = "metrics.json"
+_HDX_CALLS_FILENAME = "hdx_calls.json"
+_PROFILE_DIR = "profile"
+# Seconds between samples of disk use
+_DISK_SAMPLE_INTERVAL = 1.0
+
+
+def _get_shard(shard):
+    # Shards are given as i/N with i from 1 to N
+    try:
+        index, shards = (int(x) for x in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard {shard} must be of the form i/N!") from None
+    if not 1 <= index <= shards:
+        raise ValueError(f"Shard {shard} must be from 1/{shards} to {shards}/{shards}!")
+    return index, shards
+
+
+def _get_shard_name(name, shard):
+    # Files and folders of a shard are named for it so that shards sharing a
+    # folder do not overwrite each other's
+    if shard is None:
+        return name
+    root, ext = splitext(name)
+    return f"{root}-shard-{shard[0]}-of-{shard[1]}{ext}"
 
 
 def main(
     save: bool = False,
     use_saved: bool = False,
+    cache_dir: str | None = None,
+    metrics_file: str | None = None,
+    bounded_disk: bool = False,
+    offline_dir: str | None = None,
+    hdx_latency: float = 0.0,
+    profile: bool = False,
+    prepare: bool = False,
+    shard: str | None = None,
 ) -> None:
-    """Generate dataset and create it in HDX"""
+    """Generate dataset and create it in HDX
+
+    Args:
+        save: Save downloaded data. Defaults to False.
+        use_saved: Use saved data. Defaults to False.
+        cache_dir: Folder keeping splits and published hashes between runs. Defaults to None (don't keep).
+        metrics_file: JSON file for run metrics. Defaults to None (metrics.json in cache_dir or the current folder).
+        bounded_disk: Process one category at a time, deleting its splits and resource files before the next. Defaults to False.
+        offline_dir: Folder of saved data to read instead of FAOSTAT, recording HDX calls instead of making them. Defaults to None (online).
+        hdx_latency: Seconds each recorded HDX call takes when offline. Defaults to 0.
+        profile: Profile each stage with cProfile and tracemalloc (also set by FAOSTAT_PROFILE environment variable). Defaults to False.
+        prepare: Only download and split into cache_dir for sharded runs. Defaults to False.
+        shard: Shard i/N of countries to generate and publish from splits prepared in cache_dir. Defaults to None (all countries).
+    """
+
+    if shard:
+        shard = _get_shard(shard)
+    if prepare or shard:
+        if not cache_dir:
+            raise ValueError("A cache folder is needed to prepare or shard a run!")
+        if prepare and shard:
+            raise ValueError("A run cannot both prepare and be a shard!")
+        if bounded_disk:
+            raise ValueError("Prepared splits are shared so disk use is not bounded!")
+    if cache_dir:
+        makedirs(cache_dir, exist_ok=True)
+    if metrics_file is None:
+        metrics_file = join(cache_dir or "", _get_shard_name(_METRICS_FILENAME, shard))
+    metrics = Metrics()
+    if offline_dir:
+        # Nothing is downloaded or created in HDX
+        backend = RecordingHDX(hdx_latency)
+        save = False
+        use_saved = True
+    else:
+        backend = None
+    if profile or getenv("FAOSTAT_PROFILE"):
+        # The batch folder is deleted when a run succeeds so profiles are
+        # saved with the metrics
+        profiler = Profiler(
+            join(dirname(metrics_file), _get_shard_name(_PROFILE_DIR, shard))
+        )
+    else:
+        profiler = nullcontext()
+    status = "failed"
+    try:
+        with profiler as metrics.profiler:
+            _run(
+                save,
+                use_saved,
+                cache_dir,
+                bounded_disk,
+                metrics,
+                offline_dir,
+                backend,
+                prepare,
+                shard,
+            )
+        status = "completed"
+    finally:
+        metrics.save(metrics_file, status)
+        logger.info(metrics.get_summary(status))
+        logger.info(f"Saved metrics to {metrics_file}.")
+        if backend:
+            hdx_calls_file = join(
+                dirname(metrics_file), _get_shard_name(_HDX_CALLS_FILENAME, shard)
+            )
+            backend.save(hdx_calls_file)
+            logger.info(backend.get_summary())
+            logger.info(f"Saved HDX calls to {hdx_calls_file}.")
+
 
+def _run(
+    save,
+    use_saved,
+    cache_dir,
+    bounded_disk,
+    metrics,
+    offline_dir,
+    backend,
+    prepare,
+    shard,
+):
     configuration = Configuration.read()
+    if backend:
+        setup_offline(configuration, backend)
     filelist_url = configuration["filelist_url"]
     categories = configuration["categories"]
     showcase_base_url = configuration["showcase_base_url"]
     with Download() as downloader:
-        with wheretostart_tempdir_batch(lookup) as info:
+        # Each shard has its own batch folder and so its own progress
+        with wheretostart_tempdir_batch(_get_shard_name(lookup, shard)) as info:
             folder = info["folder"]
             batch = info["batch"]
             retriever = Retrieve(
                 downloader=downloader,
                 fallback_dir=folder,
-                saved_dir=_SAVED_DATA_DIR,
+                saved_dir=offline_dir or _SAVED_DATA_DIR,
                 temp_dir=folder,
                 save=save,
                 use_saved=use_saved,
             )
-            indicatorsets = download_indicatorsets(
-                filelist_url, categories, retriever, folder
-            )
-            logger.info(f"Number of categories to upload: {len(categories)}")
-            countries, countrymapping = get_countries(
-                script_dir_plus_file(
-                    join("config", "FAOSTAT_CountryGroups.csv"),
-                    main,
-                ),
-                retriever,
-            )
+            with metrics.timer("countries"):
+                countries, countrymapping = get_countries(
+                    script_dir_plus_file(
+                        join("config", "FAOSTAT_CountryGroups.csv"),
+                        main,
+                    ),
+                    retriever,
+                )
+            if shard:
+                countries = get_shard_countries(countries, *shard)
+                logger.info(f"Shard {shard[0]} of {shard[1]}.")
             logger.info(f"Number of countries to upload: {len(countries)}")
-            #            log_latest_dates(indicatorsets, [x["countrycode"] for x in countries])
-            for info, country in progress_storing_folder(info, countries, "iso3"):
-                for categoryname in indicatorsets:
-                    (
-                        dataset,
-                        showcase,
-                    ) = generate_dataset_and_showcase(
-                        categoryname,
-                        categories,
-                        indicatorsets,
-                        country,
-                        countrymapping,
-                        showcase_base_url,
+            # Only rows for countries that will be uploaded are split out
+            areacodes = {country["countrycode"] for country in countries}
+            if metrics.profiler:
+                # Stages in worker processes cannot be profiled
+                logger.info("Profiling so splitting and generating in this process.")
+                split_workers = 1
+                generate_workers = 1
+            else:
+                split_workers = configuration.get("split_workers", 1)
+                generate_workers = configuration.get("generate_workers", 1)
+            download_options = {
+                "prefetch": configuration.get("download_prefetch", 1),
+                "split_workers": split_workers,
+                "areacodes": areacodes,
+                "split_options": configuration.get("split"),
+                "cache_dir": cache_dir,
+                "metrics": metrics,
+                "stream": configuration.get("stream_downloads", False),
+            }
+            if configuration.get("fan_out"):
+                # Resource files are written directly from the bulk files
+                download_options["resource_countries"] = {
+                    country["countrycode"]: country["iso3"] for country in countries
+                }
+            logger.info(f"Number of categories to upload: {len(categories)}")
+            if cache_dir:
+                # Hashes of what was last published so that datasets whose
+                # metadata and files are unchanged are not published again
+                published_path = join(
+                    cache_dir, _get_shard_name(published_filename, shard)
+                )
+                published = load_state(published_path)
+            else:
+                published = None
+            published_lock = Lock()
+
+            def publish(dataset, showcase, hashes):
+                with metrics.timer("publish"):
+                    dataset.create_in_hdx(
+                        remove_additional_resources=True,
+                        updated_by_script="HDX Scraper: FAOStat",
+                        batch=batch,
+                    )
+                    showcase.create_in_hdx()
+                    showcase.add_dataset(dataset)
+                if published is not None:
+                    with published_lock:
+                        published[dataset["name"]] = hashes
+                        save_state(published_path, published)
+
+            def generate_and_publish(
+                publisher, generator, indicatorsets, categoryname, country
+            ):
+                # Returns the resource files generated for the dataset
+                dataset, showcase = generator.get(indicatorsets, categoryname, country)
+                if not dataset:
+                    return []
+                files = [x.get_file_to_upload() for x in dataset.get_resources()]
+                dataset.update_from_yaml(
+                    path=script_dir_plus_file(
+                        join("config", "hdx_dataset_static.yaml"),
+                        main,
+                    )
+                )
+                hashes = None
+                if published is not None:
+                    hashes = get_publish_hashes(dataset, showcase)
+                    if published.get(dataset["name"]) == hashes:
+                        logger.info(f"{dataset['name']} is unchanged.")
+                        metrics.add("datasets_unchanged")
+                        return files
+                publisher.submit(publish, dataset, showcase, hashes)
+                metrics.add("datasets_published")
+                return files
+
+            def get_generator():
+                return Generator(
+                    configuration,
+                    categories,
+                    countrymapping,
+                    showcase_base_url,
+                    filelist_url,
+                    retriever,
+                    folder,
+                    workers=generate_workers,
+                    metrics=metrics,
+                    local_reader=configuration.get("local_reader", False),
+                )
+
+            disk_paths = [folder]
+            if cache_dir:
+                disk_paths.append(cache_dir)
+
+            def record_disk_usage():
+                metrics.record_disk_usage(disk_paths)
+
+            def sample_disk_usage():
+                return metrics.sample_disk_usage(disk_paths, _DISK_SAMPLE_INTERVAL)
+
+            def delete_splits(indicatorsets):
+                for rows in indicatorsets.values():
+                    for row in rows:
+                        split_dir = row.get("split_dir")
+                        if split_dir and exists(split_dir):
+                            rmtree(split_dir)
+                            logger.info(f"Deleted {split_dir}.")
+
+            def delete_files(files):
+                deleted = 0
+                for file in files:
+                    if file and exists(file):
+                        unlink(file)
+                        deleted += 1
+                if deleted:
+                    logger.info(f"Deleted {deleted} resource files.")
+
+            if bounded_disk:
+                # Each category is downloaded, split and generated for every
+                # country, then its splits and resource files are deleted
+                # before the next category is started. Progress is stored by
+                # category.
+                with (
+                    sample_disk_usage(),
+                    get_generator() as generator,
+                    Publisher(
+                        configuration,
+                        info,
+                        "category",
+                        metrics=metrics,
+                        **configuration.get("publish", {}),
+                    ) as publisher,
+                ):
+                    for _, item in progress_storing_folder(
+                        info, [{"category": x} for x in categories], "category"
+                    ):
+                        categoryname = item["category"]
+                        publisher.start(categoryname)
+                        indicatorsets = download_indicatorsets(
+                            filelist_url,
+                            {categoryname: categories[categoryname]},
+                            retriever,
+                            folder,
+                            **download_options,
+                        )
+                        record_disk_usage()
+                        log_latest_dates(indicatorsets, areacodes)
+                        files = []
+                        if categoryname in indicatorsets:
+                            for country in countries:
+                                generator.submit(indicatorsets, categoryname, country)
+                            for country in countries:
+                                files.extend(
+                                    generate_and_publish(
+                                        publisher,
+                                        generator,
+                                        indicatorsets,
+                                        categoryname,
+                                        country,
+                                    )
+                                )
+                        record_disk_usage()
+                        # Resource files are needed until they are published
+                        publisher.wait()
+                        delete_splits(indicatorsets)
+                        delete_files(files)
+                logger.info("Run completed.")
+                return
+
+            indicatorsets_path = join(cache_dir or "", indicatorsets_filename)
+            if shard:
+                # Shards only read the prepared splits
+                if not exists(indicatorsets_path):
+                    raise ValueError(
+                        f"No prepared splits in {cache_dir}. Run with --prepare first!"
+                    )
+                indicatorsets = dict(load_state(indicatorsets_path))
+            else:
+                with sample_disk_usage():
+                    indicatorsets = download_indicatorsets(
                         filelist_url,
+                        categories,
                         retriever,
-                        info["folder"],
+                        folder,
+                        **download_options,
                     )
-                    if dataset:
-                        dataset.update_from_yaml(
-                            path=script_dir_plus_file(
-                                join("config", "hdx_dataset_static.yaml"),
-                                main,
-                            )
-                        )
-                        dataset.create_in_hdx(
-                            remove_additional_resources=True,
-                            updated_by_script="HDX Scraper: FAOStat",
-                            batch=batch,
+            if prepare:
+                # Saved as a list to keep the order of categories
+                save_state(indicatorsets_path, list(indicatorsets.items()))
+                logger.info(f"Prepared splits in {cache_dir}.")
+                return
+            record_disk_usage()
+            log_latest_dates(indicatorsets, areacodes)
+            with (
+                sample_disk_usage(),
+                get_generator() as generator,
+                Publisher(
+                    configuration,
+                    info,
+                    "iso3",
+                    metrics=metrics,
+                    **configuration.get("publish", {}),
+                ) as publisher,
+            ):
+                for _, country in progress_storing_folder(info, countries, "iso3"):
+                    publisher.start(country["iso3"])
+                    # The next countries are generated in worker processes
+                    # while this one is published
+                    index = countries.index(country)
+                    for upcoming in countries[index : index + generator.workers]:
+                        for categoryname in indicatorsets:
+                            generator.submit(indicatorsets, categoryname, upcoming)
+                    for categoryname in indicatorsets:
+                        generate_and_publish(
+                            publisher, generator, indicatorsets, categoryname, country
                         )
-                        showcase.create_in_hdx()
-                        showcase.add_dataset(dataset)
+            record_disk_usage()
             logger.info("Run completed. Cleaning up...")
-            for rows in indicatorsets.values():
-                for row in rows:
-                    split_dir = row.get("split_dir")
-                    if split_dir and exists(split_dir):
-                        rmtree(split_dir)
-                        logger.info(f"Deleted {split_dir}.")
+            if cache_dir:
+                # Splits are kept for the next incremental run
+                return
+            delete_splits(indicatorsets)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+"""
+Generate:
+---------
+
+Generates datasets and showcases for countries in a pool of worker processes
+while the main process publishes them. Workers are set up with the HDX
+configuration and the lookups (locations, tags, formats, countries) read in
+the main process so that they make no calls to HDX. Each worker returns a
+serializable spec of the dataset, its resource files and the showcase from
+which the main process rebuilds them for publishing.
+
+"""
+
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from time import perf_counter
+
+from hdx.api.configuration import Configuration
+from hdx.api.locations import Locations
+from hdx.data.dataset import Dataset
+from hdx.data.resource import Resource
+from hdx.data.showcase import Showcase
+from hdx.data.vocabulary import Vocabulary
+from hdx.location.country import Country
+from hdx.utilities.downloader import Download
+from hdx.utilities.retriever import Retrieve
+
+from .metrics import Metrics
+from .pipeline import generate_dataset_and_showcase
+
+logger = logging.getLogger(__name__)
+
+# Set up in each worker process by _init_worker
+_worker = {}
+
+
+def get_lookups(configuration):
+    """Get what generating datasets needs from HDX so that it can be handed
+    to worker processes.
+
+    Args:
+        configuration: HDX configuration
+
+    Returns:
+        Dictionary of lookups
+    """
+    approved_vocabulary = Vocabulary.get_approved_vocabulary(
+        configuration=configuration
+    )
+    return {
+        "configuration": configuration.data,
+        "hdx_url": configuration.get_hdx_site_url(),
+        "user_agent": configuration.get_user_agent(),
+        "validlocations": Locations.validlocations(configuration),
+        "tags": Vocabulary.read_tags_mappings(configuration=configuration),
+        # Only the tags and id of the approved vocabulary are used
+        "approved_vocabulary": dict(approved_vocabulary),
+        "formats": Resource.read_formats_mappings(configuration=configuration),
+        "countriesdata": Country.countriesdata(),
+        "log_level": logging.getLogger().getEffectiveLevel(),
+    }
+
+
+def _init_worker(lookups, generate_args):
+    logging.basicConfig(
+        level=lookups["log_level"], format="%(levelname)s - %(name)s - %(message)s"
+    )
+    # Read only as workers never call HDX
+    Configuration.setup(
+        hdx_base_config_dict=lookups["configuration"],
+        hdx_config_dict={"hdx_read_only": True},
+        hdx_url=lookups["hdx_url"],
+        hdx_read_only=True,
+        full_agent=lookups["user_agent"],
+    )
+    Locations.set_validlocations(lookups["validlocations"])
+    Vocabulary.set_tagsdict(lookups["tags"])
+    Vocabulary._approved_vocabulary = lookups["approved_vocabulary"]
+    Resource.set_formatsdict(lookups["formats"])
+    Country._countriesdata = lookups["countriesdata"]
+    folder = generate_args["folder"]
+    # Only used to read local files
+    downloader = Download(full_agent=lookups["user_agent"])
+    _worker["retriever"] = Retrieve(
+        downloader=downloader,
+        fallback_dir=folder,
+        saved_dir=folder,
+        temp_dir=folder,
+        save=False,
+        use_saved=False,
+    )
+    _worker["generate_args"] = generate_args
+
+
+def get_spec(dataset, showcase):
+    """Get a serializable spec of a dataset and showcase.
+
+    Args:
+        dataset: Dataset or None
+        showcase: Showcase or None
+
+    Returns:
+        Spec of dataset and showcase or None if there is no dataset
+    """
+    if dataset is None:
+        return None
+    return {
+        "dataset": dataset.data,
+        "resources": [
+            {"data": x.data, "file_to_upload": x.get_file_to_upload()}
+            for x in dataset.get_resources()
+        ],
+        "showcase": showcase.data,
+    }
+
+
+def build_dataset_and_showcase(spec):
+    """Rebuild a dataset and showcase from a spec.
+
+    Args:
+        spec: Spec of dataset and showcase or None
+
+    Returns:
+        (dataset, showcase) or (None, None) if spec is None
+    """
+    if spec is None:
+        return None, None
+    dataset = Dataset(spec["dataset"])
+    for resourcespec in spec["resources"]:
+        resource = Resource(resourcespec["data"])
+        resource.set_file_to_upload(resourcespec["file_to_upload"])
+        dataset.add_update_resource(resource)
+    return dataset, Showcase(spec["showcase"])
+
+
+def _generate(indicatorsets, categoryname, country):
+    # Runs in a worker process. Metrics are returned to be merged into those
+    # of the run.
+    metrics = Metrics()
+    generate_args = _worker["generate_args"]
+    start = perf_counter()
+    dataset, showcase = generate_dataset_and_showcase(
+        categoryname,
+        generate_args["categories"],
+        indicatorsets,
+        country,
+        generate_args["countrymapping"],
+        generate_args["showcase_base_url"],
+        generate_args["filelist_url"],
+        _worker["retriever"],
+        generate_args["folder"],
+        metrics,
+        generate_args["local_reader"],
+    )
+    metrics.add_time("generate", perf_counter() - start)
+    return get_spec(dataset, showcase), metrics.get_counts()
+
+
+class Generator:
+    """Generate datasets and showcases in a pool of worker processes. Calls
+    to submit queue generation of a country's dataset for a category ahead of
+    it being needed and get returns it once generated. With one worker,
+    datasets are generated in the main process when get is called.
+
+    Args:
+        configuration: HDX configuration
+        categories: Categories from the project configuration
+        countrymapping: Mapping from country code to (iso3, name)
+        showcase_base_url: Base url of showcases
+        filelist_url: Url of FAOSTAT bulk downloads file list
+        retriever: Retrieve object used when there is one worker
+        folder: Folder in which to write resource files
+        workers: Number of worker processes. Defaults to 1.
+        metrics: Metrics in which to record generation. Defaults to None.
+        local_reader: Read split files with read_split_rows. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        configuration,
+        categories,
+        countrymapping,
+        showcase_base_url,
+        filelist_url,
+        retriever,
+        folder,
+        workers=1,
+        metrics=None,
+        local_reader=False,
+    ):
+        self.configuration = configuration
+        self.generate_args = {
+            "categories": categories,
+            "countrymapping": countrymapping,
+            "showcase_base_url": showcase_base_url,
+            "filelist_url": filelist_url,
+            "folder": folder,
+            "local_reader": local_reader,
+        }
+        self.retriever = retriever
+        self.workers = max(workers, 1)
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.futures = {}
+        self.executor = None
+
+    def __enter__(self):
+        if self.workers > 1:
+            # Workers are spawned rather than forked as publishing threads
+            # may be running
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(get_lookups(self.configuration), self.generate_args),
+            )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.futures = {}
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=exc_type is not None)
+            self.executor = None
+
+    def submit(self, indicatorsets, categoryname, country):
+        if self.executor is None:
+            return
+        key = (categoryname, country["iso3"])
+        if key in self.futures:
+            return
+        # Only the category's indicator sets are sent to the worker
+        self.futures[key] = self.executor.submit(
+            _generate,
+            {categoryname: indicatorsets[categoryname]},
+            categoryname,
+            country,
+        )
+
+    def get(self, indicatorsets, categoryname, country):
+        """Get generated dataset and showcase, generating it if it was not
+        submitted.
+
+        Args:
+            indicatorsets: Dictionary of indicator sets by category
+            categoryname: Category name
+            country: Country dictionary
+
+        Returns:
+            (dataset, showcase) or (None, None) if there is no data
+        """
+        if self.executor is None:
+            with self.metrics.timer("generate"):
+                return generate_dataset_and_showcase(
+                    categoryname,
+                    self.generate_args["categories"],
+                    indicatorsets,
+                    country,
+                    self.generate_args["countrymapping"],
+                    self.generate_args["showcase_base_url"],
+                    self.generate_args["filelist_url"],
+                    self.retriever,
+                    self.generate_args["folder"],
+                    self.metrics,
+                    self.generate_args["local_reader"],
+                )
+        self.submit(indicatorsets, categoryname, country)
+        future = self.futures.pop((categoryname, country["iso3"]))
+        spec, counts = future.result()
+        self.metrics.merge(counts)
+        return build_dataset_and_showcase(spec)
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+"""
+Metrics:
+--------
+
+Records how long each stage of a run takes, how many bytes are downloaded,
+extracted and written, how many rows are processed per indicator set code,
+the latency of every call to HDX and peak memory and disk use. Stages may be recorded
+from several threads at once so their times are the sum over threads. At the
+end of a run the metrics are saved as JSON and summarised in one log line.
+
+"""
+
+import json
+import logging
+import resource
+from contextlib import contextmanager, nullcontext
+from datetime import UTC, datetime
+from os import walk
+from os.path import getsize, join
+from threading import Event, Lock, Thread
+from time import monotonic, perf_counter
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the buckets of HDX call latency histograms
+latency_buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "TB"
+    return f"{size:.1f} {unit}"
+
+
+def get_disk_usage(path):
+    size = 0
+    for root, _, filenames in walk(path):
+        for filename in filenames:
+            try:
+                size += getsize(join(root, filename))
+            except OSError:
+                # File removed while walking
+                pass
+    return size
+
+
+def get_peak_rss():
+    # ru_maxrss is in kilobytes on Linux. Split worker processes are only
+    # included once they have exited.
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+    }
+
+
+class Metrics:
+    """Collect the metrics of a run. All methods can be called from any
+    thread. Stages are also profiled if profiler is set.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.profiler = None
+        self.started = datetime.now(UTC)
+        self.start = monotonic()
+        self.stages = {}
+        self.counters = {}
+        self.rows = {}
+        self.latencies = {}
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            times = self.stages.get(stage)
+            if times is None:
+                times = {"seconds": 0.0, "count": 0}
+                self.stages[stage] = times
+            times["seconds"] += seconds
+            times["count"] += 1
+
+    def profile(self, stage):
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.stage(stage)
+
+    @contextmanager
+    def timer(self, stage):
+        start = perf_counter()
+        try:
+            with self.profile(stage):
+                yield
+        finally:
+            self.add_time(stage, perf_counter() - start)
+
+    def add(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def set_max(self, counter, value):
+        with self.lock:
+            self.counters[counter] = max(self.counters.get(counter, 0), value)
+
+    def record_disk_usage(self, paths):
+        usage = sum(get_disk_usage(x) for x in paths)
+        self.set_max("peak_disk_bytes", usage)
+
+    @contextmanager
+    def sample_disk_usage(self, paths, interval=1.0):
+        """Record the peak disk use of paths, sampling it every interval
+        seconds in a thread so that files written and deleted within a stage
+        are counted.
+
+        Args:
+            paths: Folders whose disk use to sample
+            interval: Seconds between samples. Defaults to 1.
+        """
+        stop = Event()
+
+        def sample():
+            while not stop.wait(interval):
+                self.record_disk_usage(paths)
+
+        thread = Thread(target=sample, name="faostat-disk", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def add_rows(self, kind, code, rows):
+        with self.lock:
+            codes = self.rows.setdefault(kind, {})
+            codes[code] = codes.get(code, 0) + rows
+
+    def add_latency(self, call, seconds):
+        with self.lock:
+            latency = self.latencies.get(call)
+            if latency is None:
+                latency = {
+                    "count": 0,
+                    "seconds": 0.0,
+                    "max_seconds": 0.0,
+                    "buckets": dict.fromkeys(
+                        [str(x) for x in latency_buckets] + ["inf"], 0
+                    ),
+                }
+                self.latencies[call] = latency
+            latency["count"] += 1
+            latency["seconds"] += seconds
+            latency["max_seconds"] = max(latency["max_seconds"], seconds)
+            for bound in latency_buckets:
+                if seconds <= bound:
+                    latency["buckets"][str(bound)] += 1
+                    break
+            else:
+                latency["buckets"]["inf"] += 1
+
+    def get_counts(self):
+        # Stage times, counters and rows that can be sent from a worker
+        # process to be merged into the metrics of the run
+        with self.lock:
+            return {
+                "stages": {stage: dict(x) for stage, x in self.stages.items()},
+                "counters": dict(self.counters),
+                "rows": {kind: dict(codes) for kind, codes in self.rows.items()},
+            }
+
+    def merge(self, counts):
+        with self.lock:
+            for stage, x in counts["stages"].items():
+                times = self.stages.setdefault(stage, {"seconds": 0.0, "count": 0})
+                times["seconds"] += x["seconds"]
+                times["count"] += x["count"]
+            for counter, value in counts["counters"].items():
+                self.counters[counter] = self.counters.get(counter, 0) + value
+            for kind, codes in counts["rows"].items():
+                rows = self.rows.setdefault(kind, {})
+                for code, value in codes.items():
+                    rows[code] = rows.get(code, 0) + value
+
+    def get_report(self, status="completed"):
+        """Get the metrics as a dictionary that can be saved as JSON.
+
+        Args:
+            status: Status of run. Defaults to "completed".
+
+        Returns:
+            Dictionary of metrics
+        """
+        with self.lock:
+            return {
+                "status": status,
+                "started": self.started.isoformat(timespec="seconds"),
+                "seconds": round(monotonic() - self.start, 3),
+                "stages": {
+                    stage: {"seconds": round(x["seconds"], 3), "count": x["count"]}
+                    for stage, x in self.stages.items()
+                },
+                "counters": dict(self.counters),
+                "rows": {kind: dict(codes) for kind, codes in self.rows.items()},
+                "hdx_latency": {
+                    call: dict(x, buckets=dict(x["buckets"]))
+                    for call, x in self.latencies.items()
+                },
+                "peak_rss_bytes": get_peak_rss(),
+            }
+
+    def save(self, path, status="completed"):
+        with open(path, "w") as f:
+            json.dump(self.get_report(status), f, indent=2)
+
+    def get_summary(self, status="completed"):
+        """Get a one line summary of the metrics.
+
+        Args:
+            status: Status of run. Defaults to "completed".
+
+        Returns:
+            Summary of metrics
+        """
+        report = self.get_report(status)
+        counters = report["counters"]
+        parts = [f"Run {status} in {report['seconds']:.1f}s"]
+        for stage, times in report["stages"].items():
+            parts.append(f"{stage} {times['seconds']:.1f}s")
+        for counter in ("bytes_downloaded", "bytes_extracted", "bytes_written"):
+            if counter in counters:
+                name = counter.removeprefix("bytes_")
+                parts.append(f"{format_bytes(counters[counter])} {name}")
+        if "peak_disk_bytes" in counters:
+            parts.append(f"peak disk {format_bytes(counters['peak_disk_bytes'])}")
+        for kind, codes in report["rows"].items():
+            parts.append(f"{sum(codes.values())} rows {kind} ({len(codes)} codes)")
+        latencies = report["hdx_latency"].values()
+        calls = sum(x["count"] for x in latencies)
+        if calls:
+            mean = sum(x["seconds"] for x in latencies) / calls
+            slowest = max(x["max_seconds"] for x in latencies)
+            parts.append(f"{calls} HDX calls (mean {mean:.2f}s, max {slowest:.2f}s)")
+        peak_rss = report["peak_rss_bytes"]
+        parts.append(
+            f"peak RSS {format_bytes(peak_rss['self'])} (workers {format_bytes(peak_rss['children'])})"
+        )
+        return " | ".join(parts)
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+"""
+Offline:
+--------
+
+Lets a whole run be profiled without network access. Bulk files are read from
+a local folder (eg. the saved data of a run made with --save) and every call
+that datasets and showcases make to HDX goes to a recording backend that
+keeps what is created in memory, sleeps to simulate HDX's latency and records
+each call. The lookups that would otherwise be read from HDX and elsewhere
+online are set up locally.
+
+"""
+
+import json
+import logging
+from collections import Counter
+from copy import deepcopy
+from os import fstat
+from threading import Lock
+from time import sleep
+from uuid import uuid4
+
+from ckanapi.errors import NotFound
+from hdx.api.locations import Locations
+from hdx.data.resource import Resource
+from hdx.data.vocabulary import Vocabulary
+from hdx.location.country import Country
+
+logger = logging.getLogger(__name__)
+
+
+class RecordingHDX:
+    """Stand in for the HDX CKAN API that supports the actions used to
+    create datasets and showcases. Objects are kept in memory so that a
+    dataset or showcase created twice is updated the second time as it would
+    be in HDX. Any other action returns an empty result. Calls may be made
+    from any thread.
+
+    Args:
+        latency: Seconds each call takes. Defaults to 0.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = Lock()
+        self.objects = {}
+        self.showcase_packages = {}
+        self.calls = []
+
+    def call_remoteckan(self, action, data=None, files=None, **kwargs):
+        if data is None:
+            data = {}
+        uploaded = 0
+        for file in (files or {}).values():
+            uploaded += fstat(file.fileno()).st_size
+        if self.latency:
+            sleep(self.latency)
+        with self.lock:
+            self.calls.append(
+                {
+                    "action": action,
+                    "id": data.get("id") or data.get("name") or data.get("match"),
+                    "bytes_uploaded": uploaded,
+                }
+            )
+            # Callers modify what they are given so copies are returned
+            return deepcopy(self.handle(action, data))
+
+    def get(self, key):
+        obj = self.objects.get(key)
+        if obj is None:
+            raise NotFound(f"{key} not found")
+        return obj
+
+    def put(self, obj):
+        obj = deepcopy(obj)
+        obj.setdefault("id", str(uuid4()))
+        for resource in obj.get("resources", []):
+            resource.setdefault("id", str(uuid4()))
+            resource["package_id"] = obj["id"]
+        self.objects[obj["id"]] = obj
+        if obj.get("name"):
+            self.objects[obj["name"]] = obj
+        return obj
+
+    def revise(self, data):
+        match = json.loads(data["match"])
+        obj = deepcopy(self.get(match.get("id") or match.get("name")))
+        for key in json.loads(data.get("filter", "[]")):
+            # Filters of the form -key or -key__index remove what they name
+            key, _, index = key.removeprefix("-").partition("__")
+            if not index:
+                obj.pop(key, None)
+            elif int(index) < len(obj.get(key, [])):
+                del obj[key][int(index)]
+        for key, value in json.loads(data.get("update", "{}")).items():
+            existing = obj.get(key)
+            if isinstance(existing, list) and isinstance(value, list):
+                # Dictionaries in lists are updated by position
+                existing = [dict(x) for x in existing]
+                for i, element in enumerate(value):
+                    if i < len(existing) and isinstance(element, dict):
+                        existing[i].update(element)
+                    else:
+                        existing.append(element)
+                value = existing
+            obj[key] = value
+        return {"package": self.put(obj)}
+
+    def handle(self, action, data):
+        if action.endswith("_show"):
+            return self.get(data.get("id") or data.get("name"))
+        if action == "package_revise":
+            return self.revise(data)
+        if action.endswith(("_create", "_update")) and "association" not in action:
+            return self.put(data)
+        if action == "ckanext_showcase_package_association_create":
+            packages = self.showcase_packages.setdefault(data["showcase_id"], [])
+            packages.append({"id": data["package_id"]})
+            return {}
+        if action == "ckanext_showcase_package_list":
+            return self.showcase_packages.get(data["showcase_id"], [])
+        return {}
+
+    def get_counts(self):
+        with self.lock:
+            return dict(Counter(x["action"] for x in self.calls))
+
+    def get_summary(self):
+        counts = self.get_counts()
+        calls = ", ".join(f"{count} {action}" for action, count in counts.items())
+        uploaded = sum(x["bytes_uploaded"] for x in self.calls)
+        return (
+            f"Recorded {len(self.calls)} HDX calls ({calls}) uploading {uploaded} bytes"
+        )
+
+    def save(self, path):
+        with self.lock:
+            calls = list(self.calls)
+        with open(path, "w") as f:
+            json.dump(
+                {"latency": self.latency, "counts": self.get_counts(), "calls": calls},
+                f,
+                indent=2,
+            )
+
+
+def setup_offline(configuration, backend):
+    """Point HDX calls made through configuration at backend and set up the
+    lookups needed to generate datasets without network access.
+
+    Args:
+        configuration: HDX configuration
+        backend: RecordingHDX to which to send HDX calls
+
+    Returns:
+        None
+    """
+    configuration.call_remoteckan = backend.call_remoteckan
+    countriesdata = Country.countriesdata(use_live=False)
+    Locations.set_validlocations(
+        [
+            {"name": iso3.lower(), "title": Country.get_country_name_from_iso3(iso3)}
+            for iso3 in countriesdata["countries"]
+        ]
+    )
+    tags = sorted(
+        {
+            tag
+            for category in configuration["categories"].values()
+            for tag in category.get("tags", [])
+        }
+    )
+    Vocabulary.set_tagsdict({tag: {"Action to Take": "ok"} for tag in tags})
+    Vocabulary._approved_vocabulary = {
+        "tags": [{"name": tag} for tag in tags],
+        "id": "offline",
+        "name": "approved",
+    }
+    Resource.set_formatsdict({"csv": "csv"})
@@ -8,65 +8,667 @@ Reads FAOSTAT JSON and creates datasets.
 """
 
 import csv
+import gzip
 import logging
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, closing
 from datetime import datetime
-from os import makedirs, rename, unlink
-from os.path import basename, exists, join
+from functools import cache
+from io import BufferedReader, StringIO, TextIOWrapper
+from itertools import chain
+from multiprocessing import get_context
+from os import makedirs, rename, scandir, unlink
+from os.path import basename, dirname, exists, getsize, join
+from queue import Empty, Full, Queue
+from shutil import rmtree
+from threading import Event
+from time import perf_counter
 from urllib.parse import urlsplit
 from zipfile import ZipFile
 
 from hdx.data.dataset import Dataset
 from hdx.data.hdxobject import HDXError
+from hdx.data.resource import Resource
 from hdx.data.showcase import Showcase
 from hdx.location.country import Country
 from hdx.utilities.dateparse import parse_date_range
 from hdx.utilities.dictandlist import dict_of_lists_add
+from hdx.utilities.downloader import Download
 from slugify import slugify
 
+from .metrics import Metrics
+from .rowstore import RowStoreWriter, get_area_rows, store_filename
+from .splitwriter import (
+    SplitWriter,
+    default_buffer_size,
+    default_max_handles,
+    get_split_filename,
+)
+from .state import (
+    get_cached_entry,
+    get_checksum,
+    get_split_fingerprint,
+    get_validators,
+    is_not_modified,
+    load_state,
+    save_state,
+    state_filename,
+)
+from .zipstream import ZipStream
+from .zipstream import chunk_size as zipstream_chunk_size
+
 logger = logging.getLogger(__name__)
 
+# Keys of codes entries in the categories configuration that filter rows and
+# the bulk CSV columns that they filter on
+filter_fields = {"items": "Item Code", "elements": "Element Code"}
+
 description = "FAO statistics collates and disseminates food and agricultural statistics globally. The division develops methodologies and standards for data collection, and holds regular meetings and workshops to support member countries develop statistical systems. We produce publications, working papers and statistical yearbooks that cover food security, prices, production and trade and agri-environmental statistics."
 
 
-def split_csv_by_country(filepath, split_dir):
-    handles = {}
-    writers = {}
+def get_code_description(code_config):
+    # Entries of codes are either the description or a dictionary with the
+    # description and optional filters
+    if isinstance(code_config, str):
+        return code_config
+    return code_config["description"]
+
+
+def get_code_filters(code_config):
+    """Get the filters of an entry of codes in the categories configuration.
+    An entry may have items and elements dictionaries, each with include
+    and/or exclude lists of codes, eg.
+
+        QCL:
+          description: "faostat-crops-livestock-products"
+          elements:
+            include: [5510]
+
+    Args:
+        code_config: Entry of codes in the categories configuration
+
+    Returns:
+        List of [column, codes to include or None, codes to exclude] or None
+    """
+    if isinstance(code_config, str):
+        return None
+    filters = []
+    for key, fieldname in filter_fields.items():
+        codes = code_config.get(key)
+        if not codes:
+            continue
+        include = codes.get("include")
+        if include is not None:
+            include = sorted(str(x) for x in include)
+        exclude = sorted(str(x) for x in codes.get("exclude", []))
+        filters.append([fieldname, include, exclude])
+    return filters or None
+
+
+def _get_filter_indices(filters, fieldnames):
+    indices = []
+    for fieldname, _, _ in filters:
+        if fieldname not in fieldnames:
+            raise ValueError(f"Bulk CSV has no {fieldname} column to filter on!")
+        indices.append(fieldnames.index(fieldname))
+    return indices
+
+
+def _get_filter_sets(filters):
+    # Codes are held both as str and bytes so that fields extracted directly
+    # from the raw bytes of lines can be looked up without decoding them
+    sets = []
+    for _, include, exclude in filters:
+        if include is not None:
+            include = set(include) | {x.encode("WINDOWS-1252") for x in include}
+        exclude = set(exclude) | {x.encode("WINDOWS-1252") for x in exclude}
+        sets.append((include, exclude))
+    return sets
+
+
+def _is_wanted(filter_sets, values):
+    for (include, exclude), value in zip(filter_sets, values):
+        if include is not None and value not in include:
+            return False
+        if value in exclude:
+            return False
+    return True
+
+
+def _get_split_writer(split_dir, header, buffer_size, max_handles, store, compress):
+    if store:
+        # Areas are sliced out of the row store so it is never compressed
+        return RowStoreWriter(join(split_dir, store_filename), header, buffer_size)
+    return SplitWriter(split_dir, header, buffer_size, max_handles, compress=compress)
+
+
+def _add_period_dates(areas, periods):
+    for area_code, area in areas.items():
+        area.update(get_period_dates(periods[area_code]))
+    return areas
+
+
+def _split_rows(
+    f,
+    split_dir,
+    areacodes=None,
+    buffer_size=default_buffer_size,
+    max_handles=default_max_handles,
+    store=False,
+    compress=False,
+    filters=None,
+):
+    # The distinct Year and Months values of each area are collected as the
+    # rows go by so that the latest data and time coverage are known without
+    # reading the splits again. Rows not wanted by filters are dropped.
+    areas = {}
+    periods = {}
+    reader = csv.DictReader(f)
+    fieldnames = reader.fieldnames
+    if fieldnames is None:
+        return areas
+    if filters:
+        _get_filter_indices(filters, fieldnames)
+        filter_names = [x[0] for x in filters]
+        filter_sets = _get_filter_sets(filters)
+    line = StringIO()
+    writer = csv.DictWriter(line, fieldnames=fieldnames)
+    writer.writeheader()
+    header = line.getvalue().encode("WINDOWS-1252")
+    with _get_split_writer(
+        split_dir, header, buffer_size, max_handles, store, compress
+    ) as splitwriter:
+        for row in reader:
+            if filters and not _is_wanted(
+                filter_sets, [row.get(x) for x in filter_names]
+            ):
+                continue
+            area_code = row.get("Area Code", "")
+            area = areas.get(area_code)
+            if area is None:
+                if areacodes is not None and area_code not in areacodes:
+                    continue
+                area = {"rows": 0}
+                areas[area_code] = area
+                periods[area_code] = set()
+            line.seek(0)
+            line.truncate()
+            writer.writerow(row)
+            splitwriter.write(area_code, line.getvalue().encode("WINDOWS-1252"))
+            area["rows"] += 1
+            periods[area_code].add((row.get("Year"), row.get("Months")))
+    return _add_period_dates(areas, periods)
+
+
+def _split_lines(
+    f,
+    split_dir,
+    areacodes=None,
+    buffer_size=default_buffer_size,
+    max_handles=default_max_handles,
+    store=False,
+    compress=False,
+    filters=None,
+):
+    # Routes the raw bytes of each line to its area's output without decoding
+    # and re-encoding it. Only the Area Code, Year and Months fields (and any
+    # filtered columns) are extracted, directly from the bytes for lines that
+    # are either entirely unquoted or have every field quoted without
+    # embedded quotes. Any other line (including those with embedded
+    # newlines) is parsed as CSV.
+    areas = {}
+    periods = {}
+    header = f.readline()
+    if not header.strip():
+        return areas
+    if not header.endswith(b"\n"):
+        header += b"\r\n"
+    fieldnames = next(csv.reader([header.decode("WINDOWS-1252")]))
+    if "Area Code" not in fieldnames:
+        lines = (x.decode("WINDOWS-1252") for x in chain((header,), f))
+        return _split_rows(
+            lines,
+            split_dir,
+            areacodes,
+            buffer_size,
+            max_handles,
+            store,
+            compress,
+            filters,
+        )
+    indices = [fieldnames.index("Area Code")]
+    for fieldname in ("Year", "Months"):
+        if fieldname in fieldnames:
+            indices.append(fieldnames.index(fieldname))
+        else:
+            indices.append(None)
+    if filters:
+        indices.extend(_get_filter_indices(filters, fieldnames))
+        filter_sets = _get_filter_sets(filters)
+    maxsplit = max(x for x in indices if x is not None) + 1
+    last_index = len(fieldnames) - 1
+    all_quoted = 2 * len(fieldnames)
+    area_codes = {}
+    pending = b""
+
+    def get_fields(parts, quoted):
+        fields = []
+        for index in indices:
+            if index is None:
+                fields.append(None)
+                continue
+            field = parts[index]
+            if quoted and index == 0:
+                field = field[1:]
+            if index == last_index:
+                field = field.rstrip(b'"\r\n' if quoted else b"\r\n")
+            fields.append(field)
+        return fields
+
+    def parse_fields(data):
+        row = next(csv.reader([data.decode("WINDOWS-1252")]), [])
+        fields = [row[x] if x is not None and len(row) > x else None for x in indices]
+        if fields[0] is None:
+            fields[0] = ""
+        return fields
+
+    with _get_split_writer(
+        split_dir, header, buffer_size, max_handles, store, compress
+    ) as splitwriter:
+        for line in f:
+            if pending:
+                line = pending + line
+                if line.count(b'"') % 2:
+                    pending = line
+                    continue
+                pending = b""
+                fields = parse_fields(line)
+            else:
+                quotes = line.count(b'"')
+                if quotes == 0:
+                    if not line.strip():
+                        continue
+                    parts = line.split(b",", maxsplit)
+                    if len(parts) <= maxsplit - 1:
+                        fields = parse_fields(line)
+                    else:
+                        fields = get_fields(parts, False)
+                elif quotes == all_quoted and line[:1] == b'"' and b'""' not in line:
+                    parts = line.split(b'","', maxsplit)
+                    if len(parts) <= maxsplit - 1:
+                        fields = parse_fields(line)
+                    else:
+                        fields = get_fields(parts, True)
+                elif quotes % 2:
+                    pending = line
+                    continue
+                else:
+                    fields = parse_fields(line)
+            if filters and not _is_wanted(filter_sets, fields[3:]):
+                continue
+            area_code, year, month = fields[:3]
+            if isinstance(area_code, bytes):
+                decoded = area_codes.get(area_code)
+                if decoded is None:
+                    decoded = area_code.decode("WINDOWS-1252")
+                    area_codes[area_code] = decoded
+                area_code = decoded
+            area = areas.get(area_code)
+            if area is None:
+                if areacodes is not None and area_code not in areacodes:
+                    continue
+                area = {"rows": 0}
+                areas[area_code] = area
+                periods[area_code] = set()
+            if not line.endswith(b"\n"):
+                line += b"\r\n"
+            splitwriter.write(area_code, line)
+            area["rows"] += 1
+            periods[area_code].add((year, month))
+        if pending:
+            raise ValueError("Bulk CSV ends inside a quoted field!")
+    return _add_period_dates(areas, periods)
+
+
+def _split_stream(raw, split_dir, areacodes=None, fast=False, **kwargs):
+    if fast:
+        return _split_lines(raw, split_dir, areacodes, **kwargs)
+    with TextIOWrapper(raw, encoding="WINDOWS-1252", newline="") as f:
+        return _split_rows(f, split_dir, areacodes, **kwargs)
+
+
+def split_csv_by_country(filepath, split_dir, areacodes=None, **kwargs):
+    with open(filepath, "rb") as raw:
+        return _split_stream(raw, split_dir, areacodes, **kwargs)
+
+
+def split_zip_member_by_country(zip_path, member, split_dir, areacodes=None, **kwargs):
+    # Reads the member as a decompressing stream so the full CSV is never
+    # written to disk
+    with ZipFile(zip_path, "r") as z:
+        with z.open(member) as raw:
+            return _split_stream(raw, split_dir, areacodes, **kwargs)
+
+
+def get_resource_filename(countryiso, description):
+    description_part = description.removeprefix("faostat-").replace("-", "_")
+    return f"{countryiso.lower()}_faostat_{description_part}.csv"
+
+
+def _fan_out_rows(
+    f,
+    resource_dir,
+    countries,
+    description,
+    buffer_size=default_buffer_size,
+    max_handles=default_max_handles,
+    filters=None,
+):
+    # Writes the finished resource file of every country in one pass: rows
+    # are given the Iso3, StartDate and EndDate columns and the end year of
+    # Year ranges as generate_resource would, and are written as UTF-8 with
+    # minimal quoting like the frictionless output. Area codes sharing an
+    # ISO3 (eg. Sudan and Sudan (former)) are written to the same file.
+    areas = {}
+    periods = {}
+    reader = csv.reader(f)
+    fieldnames = next(reader, None)
+    if fieldnames is None or "Area Code" not in fieldnames:
+        return areas
+    nfields = len(fieldnames)
+    area_index = fieldnames.index("Area Code")
+    year_index = fieldnames.index("Year")
+    if "Months" in fieldnames:
+        months_index = fieldnames.index("Months")
+    else:
+        months_index = None
+    if filters:
+        filter_indices = _get_filter_indices(filters, fieldnames)
+        filter_sets = _get_filter_sets(filters)
+    filenames = {
+        area_code: get_resource_filename(countryiso, description)
+        for area_code, countryiso in countries.items()
+    }
+    # The writer is keyed by filename so each file has one header
+    writer_filenames = {x: x for x in filenames.values()}
+    line = StringIO()
+    writer = csv.writer(line)
+    writer.writerow(["Iso3", "StartDate", "EndDate"] + fieldnames)
+    header = line.getvalue().encode("utf-8")
+    with SplitWriter(
+        resource_dir, header, buffer_size, max_handles, writer_filenames
+    ) as splitwriter:
+        for row in reader:
+            if len(row) <= area_index:
+                continue
+            area_code = row[area_index]
+            countryiso = countries.get(area_code)
+            if countryiso is None:
+                continue
+            if len(row) != nfields:
+                row = (row + [""] * nfields)[:nfields]
+            if filters and not _is_wanted(
+                filter_sets, [row[x] for x in filter_indices]
+            ):
+                continue
+            year = row[year_index]
+            if months_index is None:
+                month = None
+            else:
+                month = row[months_index]
+            row[year_index], _, _, startdatestr, enddatestr = get_date_range(
+                year, month
+            )
+            area = areas.get(area_code)
+            if area is None:
+                area = {"rows": 0}
+                areas[area_code] = area
+                periods[area_code] = set()
+            line.seek(0)
+            line.truncate()
+            writer.writerow([countryiso, startdatestr, enddatestr] + row)
+            splitwriter.write(filenames[area_code], line.getvalue().encode("utf-8"))
+            area["rows"] += 1
+            periods[area_code].add((year, month))
+    return _add_period_dates(areas, periods)
+
+
+def fan_out_csv_by_country(filepath, resource_dir, countries, description, **kwargs):
+    """Write the resource file of each country from a bulk CSV in one pass.
+
+    Args:
+        filepath: Path to bulk CSV
+        resource_dir: Folder in which to write resource files
+        countries: Dictionary of area code to ISO3 code of countries wanted
+        description: Code description from the categories configuration eg. faostat-food-security-indicators
+        **kwargs: buffer_size and max_handles to pass to SplitWriter and filters of rows
+
+    Returns:
+        Dictionary of area code to rows, latest date and date range
+    """
+    with open(filepath, encoding="WINDOWS-1252", newline="") as f:
+        return _fan_out_rows(f, resource_dir, countries, description, **kwargs)
+
+
+def fan_out_zip_member_by_country(
+    zip_path, member, resource_dir, countries, description, **kwargs
+):
+    with ZipFile(zip_path, "r") as z:
+        with z.open(member) as raw:
+            with TextIOWrapper(raw, encoding="WINDOWS-1252", newline="") as f:
+                return _fan_out_rows(f, resource_dir, countries, description, **kwargs)
+
+
+def _get_fan_out_options(split_options):
+    return {
+        key: value
+        for key, value in split_options.items()
+        if key in ("buffer_size", "max_handles", "filters")
+    }
+
+
+def _split_indicatorset(
+    zip_path,
+    member,
+    split_dir,
+    filepath=None,
+    areacodes=None,
+    split_options=None,
+    resources=None,
+):
+    # Module level so that it can be run in a worker process. Also returns
+    # the seconds taken and bytes extracted and written for the run metrics.
+    start = perf_counter()
+    if split_options is None:
+        split_options = {}
+    if exists(split_dir):
+        rmtree(split_dir)
+    makedirs(split_dir)
+    with ZipFile(zip_path, "r") as z:
+        extracted_size = z.getinfo(member).file_size
+    if filepath:
+        folder = dirname(filepath)
+        with ZipFile(zip_path, "r") as z:
+            extracted = z.extract(member, path=folder)
+            rename(extracted, filepath)
+    if resources:
+        countries, description = resources
+        kwargs = _get_fan_out_options(split_options)
+        if filepath:
+            areas = fan_out_csv_by_country(
+                filepath, split_dir, countries, description, **kwargs
+            )
+        else:
+            areas = fan_out_zip_member_by_country(
+                zip_path, member, split_dir, countries, description, **kwargs
+            )
+    elif filepath:
+        areas = split_csv_by_country(filepath, split_dir, areacodes, **split_options)
+    else:
+        areas = split_zip_member_by_country(
+            zip_path, member, split_dir, areacodes, **split_options
+        )
+    stats = {
+        "seconds": perf_counter() - start,
+        "bytes_extracted": extracted_size,
+        "bytes_written": sum(getsize(x.path) for x in scandir(split_dir)),
+    }
+    return split_dir, areas, stats
+
+
+def _stream_indicatorset(
+    url,
+    member,
+    split_dir,
+    filepath=None,
+    areacodes=None,
+    split_options=None,
+    resources=None,
+    copy_path=None,
+    user_agent=None,
+):
+    # Splits the member as the zip downloads. The zip is only written to disk
+    # if copy_path is given. Also returns what is recorded about the zip in
+    # the split state as there is no zip file to take it from.
+    start = perf_counter()
+    if split_options is None:
+        split_options = {}
+    if exists(split_dir):
+        rmtree(split_dir)
+    makedirs(split_dir)
+    with ExitStack() as stack:
+        # Its own downloader so that it can run in a worker process or
+        # alongside the download thread
+        downloader = stack.enter_context(Download(full_agent=user_agent))
+        response = downloader.setup(url, stream=True)
+        download_state = {}
+        for header in ("ETag", "Last-Modified"):
+            value = response.headers.get(header)
+            if value:
+                download_state[header] = value
+        copy = None
+        if copy_path:
+            copy = stack.enter_context(open(copy_path, "wb"))
+        extracted = None
+        if filepath:
+            extracted = stack.enter_context(open(filepath, "wb"))
+        stream = ZipStream(
+            response.iter_content(zipstream_chunk_size), member, copy, extracted
+        )
+        raw = BufferedReader(stream, zipstream_chunk_size)
+        if resources:
+            countries, description = resources
+            kwargs = _get_fan_out_options(split_options)
+            with TextIOWrapper(raw, encoding="WINDOWS-1252", newline="") as f:
+                areas = _fan_out_rows(f, split_dir, countries, description, **kwargs)
+        else:
+            areas = _split_stream(raw, split_dir, areacodes, **split_options)
+        # The rest of the zip is read so that its checksum and copy are whole
+        stream.drain()
+    download_state["checksum"] = stream.get_checksum()
+    stats = {
+        "seconds": perf_counter() - start,
+        "bytes_downloaded": stream.bytes_read,
+        "bytes_extracted": stream.size,
+        "bytes_written": sum(getsize(x.path) for x in scandir(split_dir)),
+        "download_state": download_state,
+    }
+    return split_dir, areas, stats
+
+
+def _queue_put(queue, item, stop):
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=1)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def _pipelined_downloads(tasks, download, prefetch, discard):
+    # Downloads run in a worker thread that stays at most prefetch zips ahead
+    # of the consumer, so the network is busy while the consumer splits. Zips
+    # downloaded but not consumed when the consumer stops are passed to discard
+    queue = Queue(maxsize=prefetch)
+    stop = Event()
+
+    def produce():
+        for task in tasks:
+            try:
+                item = (task, download(task), None)
+            except Exception as e:
+                item = (task, None, e)
+            if not _queue_put(queue, item, stop):
+                if item[2] is None:
+                    discard(task, item[1])
+                return
+            if item[2] is not None:
+                return
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="faostat-download")
     try:
-        with open(filepath, encoding="WINDOWS-1252", newline="") as f:
-            reader = csv.DictReader(f)
-            fieldnames = reader.fieldnames
-            for row in reader:
-                area_code = row.get("Area Code", "")
-                if area_code not in handles:
-                    out_path = join(split_dir, f"{area_code}.csv")
-                    fh = open(out_path, "w", encoding="WINDOWS-1252", newline="")
-                    handles[area_code] = fh
-                    writer = csv.DictWriter(fh, fieldnames=fieldnames)
-                    writer.writeheader()
-                    writers[area_code] = writer
-                writers[area_code].writerow(row)
+        executor.submit(produce)
+        for _ in tasks:
+            task, zip_path, error = queue.get()
+            if error is not None:
+                raise error
+            yield task, zip_path
     finally:
-        for fh in handles.values():
-            fh.close()
+        stop.set()
+        # Waits for any download in progress so that it is discarded too
+        executor.shutdown()
+        try:
+            while True:
+                task, download_result, error = queue.get_nowait()
+                if error is None:
+                    discard(task, download_result)
+        except Empty:
+            pass
 
 
-def download_indicatorsets(filelist_url, categories, retriever, folder):
+def download_indicatorsets(
+    filelist_url,
+    categories,
+    retriever,
+    folder,
+    keep_extracted=False,
+    prefetch=1,
+    split_workers=1,
+    areacodes=None,
+    split_options=None,
+    cache_dir=None,
+    metrics=None,
+    resource_countries=None,
+    stream=False,
+):
     indicatorsets = {}
+    if metrics is None:
+        metrics = Metrics()
     jsonresponse = retriever.download_json(filelist_url, "datasets_E.json")
+    # The full CSV is only extracted to disk when it is needed afterwards eg.
+    # by log_latest_dates or to be kept with the saved data
+    extract = keep_extracted or retriever.save
+    # Zips are split as they download rather than being downloaded first
+    streaming = stream and not retriever.use_saved
+    if streaming:
+        split_function = _stream_indicatorset
+    else:
+        split_function = _split_indicatorset
 
     code_to_category = {}
+    code_split_options = {}
     for categoryname, category in categories.items():
-        for code in category.get("codes", {}):
+        for code, code_config in category.get("codes", {}).items():
             code_to_category[code] = categoryname
+            filters = get_code_filters(code_config)
+            if filters:
+                # Rows not wanted are dropped when splitting
+                code_split_options[code] = dict(split_options or {}, filters=filters)
 
-    def add_row(row, filepath, categoryname, code):
-        row["path"] = filepath
-        split_dir = join(folder, f"{code}_split")
-        makedirs(split_dir, exist_ok=True)
-        split_csv_by_country(filepath, split_dir)
-        row["split_dir"] = split_dir
-        dict_of_lists_add(indicatorsets, categoryname, row)
-
+    tasks = []
     for row in jsonresponse["Datasets"]["Dataset"]:
         datasetname = row["DatasetName"]
         if "archive" in datasetname.lower():
@@ -80,20 +682,196 @@ def download_indicatorsets(filelist_url, categories, retriever, folder):
         filename = basename(urlpath).replace("zip", "csv")
         if "Archive" in filename:
             continue
-        filepath = join(folder, f"{indicatorsetcode}.csv")
-        zip_path = retriever.download_file(
-            filelocation, filename=f"{indicatorsetcode}.zip"
+        tasks.append((row, categoryname, indicatorsetcode, filelocation, filename))
+
+    if cache_dir:
+        # Splits are kept in cache_dir between runs and reused for indicator
+        # sets that have not changed since they were split
+        makedirs(cache_dir, exist_ok=True)
+        split_folder = cache_dir
+    else:
+        # The batch folder survives a failed run so a restarted run reuses the
+        # splits that were completed before it failed
+        split_folder = folder
+    # Each code is only recorded in the state once its split is complete
+    state_path = join(split_folder, state_filename)
+    state = load_state(state_path)
+    state.setdefault("codes", {})
+
+    def get_split_options(indicatorsetcode):
+        return code_split_options.get(indicatorsetcode, split_options)
+
+    def get_fingerprint(indicatorsetcode):
+        options = get_split_options(indicatorsetcode)
+        if resource_countries and options:
+            # Only the options used when fanning out change what is written
+            options = _get_fan_out_options(options)
+        return get_split_fingerprint(areacodes, options, resource_countries)
+
+    def download(task):
+        row, _, indicatorsetcode, filelocation, _ = task
+        entry = get_cached_entry(
+            state, indicatorsetcode, get_fingerprint(indicatorsetcode)
         )
-        with ZipFile(zip_path, "r") as z:
-            extracted = z.extract(filename, path=folder)
-            rename(extracted, filepath)
+        if entry is not None:
+            dateupdate = row.get("DateUpdate")
+            if dateupdate and entry.get("DateUpdate") == dateupdate:
+                logger.info(f"{indicatorsetcode} unchanged since {dateupdate}.")
+                return None, None
+            if not retriever.use_saved and is_not_modified(
+                retriever.downloader, filelocation, entry
+            ):
+                logger.info(f"{indicatorsetcode} not modified on server.")
+                return None, None
+        if streaming:
+            # Downloaded by the split
+            return filelocation, None
+        with metrics.timer("download"):
+            zip_path = retriever.download_file(
+                filelocation, filename=f"{indicatorsetcode}.zip"
+            )
+        metrics.add("bytes_downloaded", getsize(zip_path))
+        if retriever.use_saved:
+            download_state = {}
+        else:
+            download_state = get_validators(retriever.downloader)
+        download_state["checksum"] = get_checksum(zip_path)
+        if entry is not None and entry.get("checksum") == download_state["checksum"]:
+            logger.info(f"{indicatorsetcode} zip unchanged.")
+            delete_zip(indicatorsetcode, zip_path)
+            return None, download_state
+        return zip_path, download_state
+
+    def delete_zip(indicatorsetcode, zip_path, status="completed"):
         if not retriever.save and not retriever.use_saved:
             unlink(zip_path)
-            logger.info(f"Extract completed - deleted {zip_path}.")
-        add_row(row, filepath, categoryname, indicatorsetcode)
-        if not retriever.save and not retriever.use_saved:
-            unlink(filepath)
-            logger.info(f"{indicatorsetcode} completed - deleted {filepath}.")
+            logger.info(f"{indicatorsetcode} {status} - deleted {zip_path}.")
+
+    def discard(task, download_result):
+        zip_path = download_result[0]
+        if zip_path is not None and not streaming:
+            delete_zip(task[2], zip_path, "not split")
+
+    if prefetch > 0:
+        downloads = _pipelined_downloads(tasks, download, prefetch, discard)
+    else:
+        downloads = ((task, download(task)) for task in tasks)
+
+    def add_row(task, download_result, split_result):
+        row, categoryname, indicatorsetcode, _, _ = task
+        zip_path, download_state = download_result
+        if zip_path is None:
+            entry = state["codes"][indicatorsetcode]
+            split_dir = entry["split_dir"]
+            areas = entry["areas"]
+            metrics.add("codes_reused")
+        else:
+            split_dir, areas, stats = split_result
+            metrics.add_time("split", stats["seconds"])
+            metrics.add("bytes_extracted", stats["bytes_extracted"])
+            metrics.add("bytes_written", stats["bytes_written"])
+            metrics.add_rows(
+                "split", indicatorsetcode, sum(x["rows"] for x in areas.values())
+            )
+            if extract:
+                row["path"] = join(folder, f"{indicatorsetcode}.csv")
+            if streaming:
+                download_state = stats["download_state"]
+                metrics.add("bytes_downloaded", stats["bytes_downloaded"])
+            else:
+                delete_zip(indicatorsetcode, zip_path)
+        row["split_dir"] = split_dir
+        if resource_countries:
+            row["resource_dir"] = split_dir
+        elif split_options and split_options.get("store"):
+            row["split_store"] = join(split_dir, store_filename)
+        elif split_options and split_options.get("compress"):
+            row["split_compressed"] = True
+        row["areas"] = areas
+        dict_of_lists_add(indicatorsets, categoryname, row)
+        entry = state["codes"].get(indicatorsetcode, {})
+        if download_state is not None:
+            entry.update(download_state)
+        entry["DateUpdate"] = row.get("DateUpdate")
+        entry["fingerprint"] = get_fingerprint(indicatorsetcode)
+        entry["split_dir"] = split_dir
+        entry["areas"] = areas
+        state["codes"][indicatorsetcode] = entry
+        save_state(state_path, state)
+
+    def split_args(task, zip_path):
+        _, categoryname, indicatorsetcode, _, filename = task
+        split_dir = join(split_folder, f"{indicatorsetcode}_split")
+        if state["codes"].pop(indicatorsetcode, None) is not None:
+            # The split is about to be overwritten so a run that fails before
+            # it is complete must not reuse it
+            save_state(state_path, state)
+        if extract:
+            filepath = join(folder, f"{indicatorsetcode}.csv")
+        else:
+            filepath = None
+        if resource_countries:
+            description = get_code_description(
+                categories[categoryname]["codes"][indicatorsetcode]
+            )
+            resources = (resource_countries, description)
+        else:
+            resources = None
+        args = (
+            zip_path,
+            filename,
+            split_dir,
+            filepath,
+            areacodes,
+            get_split_options(indicatorsetcode),
+            resources,
+        )
+        if streaming:
+            # The zip is only kept if it would have been saved
+            if retriever.save:
+                copy_path = join(retriever.saved_dir, f"{indicatorsetcode}.zip")
+            else:
+                copy_path = None
+            user_agent = retriever.downloader.session.headers.get("User-Agent")
+            args += (copy_path, user_agent)
+        return args
+
+    with closing(downloads):
+        if split_workers > 1:
+            # At most split_workers splits are outstanding and results are
+            # collected in submission order to keep the indicatorsets order.
+            # Workers are spawned rather than forked as the download thread
+            # may be running.
+            pending = deque()
+            with ProcessPoolExecutor(
+                max_workers=split_workers, mp_context=get_context("spawn")
+            ) as executor:
+                for task, download_result in downloads:
+                    zip_path = download_result[0]
+                    if zip_path is None:
+                        future = None
+                    else:
+                        future = executor.submit(
+                            split_function, *split_args(task, zip_path)
+                        )
+                    pending.append((task, download_result, future))
+                    if len(pending) >= split_workers:
+                        task, download_result, future = pending.popleft()
+                        add_row(task, download_result, future and future.result())
+                while pending:
+                    task, download_result, future = pending.popleft()
+                    add_row(task, download_result, future and future.result())
+        else:
+            for task, download_result in downloads:
+                zip_path = download_result[0]
+                if zip_path is None:
+                    split_result = None
+                else:
+                    # Timed by the split itself so that splits in worker
+                    # processes are timed too
+                    with metrics.profile("split"):
+                        split_result = split_function(*split_args(task, zip_path))
+                add_row(task, download_result, split_result)
     return indicatorsets
 
 
@@ -141,49 +919,208 @@ def get_countries(countries_path, retriever):
     return countries, countrymapping
 
 
-def log_latest_dates(indicatorsets, countrycodes):
-    seen = {}
+def get_shard_countries(countries, shard, shards):
+    """Get the countries of one of shards independent runs. Countries are
+    assigned by a hash of their ISO3 code so that each keeps its shard when
+    others are added or removed.
+
+    Args:
+        countries: List of countries from get_countries
+        shard: Shard from 1 to shards
+        shards: Number of shards
+
+    Returns:
+        List of countries in shard
+    """
+    return [
+        country
+        for country in countries
+        if zlib.crc32(country["iso3"].encode("utf-8")) % shards == shard - 1
+    ]
+
+
+def _open_csv(filepath):
+    # Split files may be gzip compressed
+    if filepath.endswith(".gz"):
+        return gzip.open(filepath, "rt", encoding="WINDOWS-1252", newline="")
+    return open(filepath, encoding="WINDOWS-1252", newline="")
+
+
+def read_split_rows(filepath):
+    """Read a local split file for generate_resource without the per row
+    overhead of get_tabular_rows, which is built for remote tabular files.
+    The headers start with Iso3, StartDate and EndDate as get_tabular_rows
+    would give with header insertions. Their values are added to each row by
+    the date function passed to generate_resource.
+
+    Args:
+        filepath: Path of split file, which may be gzip compressed
+
+    Returns:
+        (headers, iterator of dictionary rows)
+    """
+    f = _open_csv(filepath)
+    reader = csv.DictReader(f)
+    fieldnames = reader.fieldnames or []
+
+    def get_rows():
+        with f:
+            yield from reader
+
+    return ["Iso3", "StartDate", "EndDate"] + fieldnames, get_rows()
+
+
+def _read_areas(filepath):
+    areas = {}
+    periods = {}
+    with _open_csv(filepath) as f:
+        for data_row in csv.DictReader(f):
+            area_code = data_row.get("Area Code")
+            if area_code is None:
+                continue
+            area = areas.get(area_code)
+            if area is None:
+                area = {"rows": 0}
+                areas[area_code] = area
+                periods[area_code] = set()
+            area["rows"] += 1
+            periods[area_code].add((data_row.get("Year"), data_row.get("Months")))
+    return _add_period_dates(areas, periods)
+
+
+def get_latest_dates(indicatorsets, countrycodes):
+    """Get the latest year and month of data for the given countries in each
+    indicator set. These come from what was recorded about each area when
+    splitting, only reading the bulk CSV for rows that were not split.
+
+    Args:
+        indicatorsets: Dictionary of category name to indicator set rows
+        countrycodes: Area codes of countries to consider
+
+    Returns:
+        Dictionary of indicator set code to (year, month or None)
+    """
+    seen = set()
+    latest_dates = {}
     for indicatorset in indicatorsets.values():
         for row in indicatorset:
             code = row["DatasetCode"]
-            if code not in seen:
-                seen[code] = row["path"]
-    for code, filepath in sorted(seen.items()):
-        max_year = None
-        max_month = None
-        with open(filepath, encoding="WINDOWS-1252") as f:
-            for data_row in csv.DictReader(f):
-                countrycode = data_row.get("Area Code")
-                if countrycode is None:
-                    continue
-                if countrycode not in countrycodes:
-                    continue
-                year = data_row.get("Year")
-                if not year:
-                    continue
-                try:
-                    end_year = int(year.split("-")[-1].strip())
-                except ValueError:
+            if code in seen:
+                continue
+            seen.add(code)
+            areas = row.get("areas")
+            if areas is None:
+                areas = _read_areas(row["path"])
+            latest = None
+            for countrycode in countrycodes:
+                area = areas.get(countrycode)
+                if area is None or "latest" not in area:
                     continue
-                month_str = data_row.get("Months")
-                month = None
-                if month_str and month_str != "Annual value":
-                    try:
-                        month = datetime.strptime(month_str, "%B").month
-                    except ValueError:
-                        pass
-                if max_year is None or end_year > max_year:
-                    max_year = end_year
-                    max_month = month
-                elif end_year == max_year:
-                    if month is not None and (max_month is None or month > max_month):
-                        max_month = month
-        if max_year is not None:
-            if max_month is not None:
-                label = datetime(max_year, max_month, 1).strftime("%B %Y")
-            else:
-                label = str(max_year)
-            logger.info(f"Latest date for {code}: {label}")
+                if latest is None or _get_latest_key(area["latest"]) > _get_latest_key(
+                    latest
+                ):
+                    latest = area["latest"]
+            if latest is not None:
+                latest_dates[code] = tuple(latest)
+    return latest_dates
+
+
+def log_latest_dates(indicatorsets, countrycodes):
+    latest_dates = get_latest_dates(indicatorsets, countrycodes)
+    for code, (max_year, max_month) in sorted(latest_dates.items()):
+        if max_month is not None:
+            label = datetime(max_year, max_month, 1).strftime("%B %Y")
+        else:
+            label = str(max_year)
+        logger.info(f"Latest date for {code}: {label}")
+
+
+@cache
+def get_date_range(year, month):
+    # There are few distinct Year and Months values so their date ranges are
+    # cached for the whole run rather than parsed for every row
+    if month is not None and month != "Annual value":
+        startdate, enddate = parse_date_range(f"{month} {year}")
+    else:
+        if "-" in year:
+            yearrange = year.split("-")
+            startdate, _ = parse_date_range(yearrange[0])
+            _, enddate = parse_date_range(yearrange[1])
+            year = yearrange[1]
+        else:
+            startdate, enddate = parse_date_range(year)
+    return (
+        year,
+        startdate,
+        enddate,
+        startdate.strftime("%Y-%m-%d"),
+        enddate.strftime("%Y-%m-%d"),
+    )
+
+
+@cache
+def get_latest_date(year, month):
+    # Returns the (year, month) to compare when finding the latest data, month
+    # being None for annual values, or None if year cannot be parsed
+    if not year:
+        return None
+    try:
+        end_year = int(year.split("-")[-1].strip())
+    except ValueError:
+        return None
+    if month and month != "Annual value":
+        try:
+            return end_year, datetime.strptime(month, "%B").month
+        except ValueError:
+            pass
+    return end_year, None
+
+
+def _get_latest_key(latest):
+    # Annual values come before any month of the same year
+    year, month = latest
+    return year, month or 0
+
+
+def get_period_dates(periods):
+    """Get the latest year and month and the date range covered by a set of
+    distinct (Year, Months) values from bulk CSV rows. Values may be bytes
+    (as extracted by the byte-level splitter) or str.
+
+    Args:
+        periods: Set of (Year, Months) tuples
+
+    Returns:
+        Dictionary with latest ([year, month or None]), startdate and enddate (YYYY-MM-DD) if any periods can be parsed
+    """
+    latest = None
+    startdate = None
+    enddate = None
+    for year, month in periods:
+        if isinstance(year, bytes):
+            year = year.decode("WINDOWS-1252")
+        if isinstance(month, bytes):
+            month = month.decode("WINDOWS-1252")
+        result = get_latest_date(year, month)
+        if result is None:
+            continue
+        if latest is None or _get_latest_key(result) > _get_latest_key(latest):
+            latest = result
+        try:
+            _, start, end, _, _ = get_date_range(year, month or None)
+        except ValueError:
+            continue
+        if startdate is None or start < startdate:
+            startdate = start
+        if enddate is None or end > enddate:
+            enddate = end
+    dates = {}
+    if latest is not None:
+        dates["latest"] = list(latest)
+    if startdate is not None:
+        dates["startdate"] = startdate.strftime("%Y-%m-%d")
+        dates["enddate"] = enddate.strftime("%Y-%m-%d")
+    return dates
 
 
 def generate_dataset_and_showcase(
@@ -196,7 +1133,11 @@ def generate_dataset_and_showcase(
     filelist_url,
     retriever,
     folder,
+    metrics=None,
+    local_reader=False,
 ):
+    if metrics is None:
+        metrics = Metrics()
     countryiso = country["iso3"]
     countryname = country["countryname"]
     countrycode = country["countrycode"]
@@ -231,50 +1172,96 @@ def generate_dataset_and_showcase(
         if isolookup != countryiso:
             return None
         row["Iso3"] = countryiso
-        year = row["Year"]
-        month = row.get("Months")
-        if month is not None and month != "Annual value":
-            startdate, enddate = parse_date_range(f"{month} {year}")
-        else:
-            if "-" in year:
-                yearrange = year.split("-")
-                startdate, _ = parse_date_range(yearrange[0])
-                _, enddate = parse_date_range(yearrange[1])
-                row["Year"] = yearrange[1]
-            else:
-                startdate, enddate = parse_date_range(year)
-        row["StartDate"] = startdate.strftime("%Y-%m-%d")
-        row["EndDate"] = enddate.strftime("%Y-%m-%d")
+        year, startdate, enddate, startdatestr, enddatestr = get_date_range(
+            row["Year"], row.get("Months")
+        )
+        row["Year"] = year
+        row["StartDate"] = startdatestr
+        row["EndDate"] = enddatestr
         return {"startdate": startdate, "enddate": enddate}
 
     categories = []
     for row in indicatorset:
         longname = row["DatasetName"]
+        split_store = row.get("split_store")
         split_dir = row.get("split_dir")
-        if split_dir:
-            url = join(split_dir, f"{countrycode}.csv")
-            if not exists(url):
+        areas = row.get("areas")
+        area = None
+        if areas is not None:
+            # What was recorded when splitting says up front whether there is
+            # any data for the country and what period it covers
+            area = areas.get(countrycode)
+            if area is None:
                 logger.warning(f"{longname} for {countryname} has no data!")
                 continue
-        else:
-            url = row["path"]
+            if "startdate" in area:
+                logger.info(
+                    f"{longname} for {countryname} covers {area['startdate']} to {area['enddate']}"
+                )
         category = longname
         indicatorsetcode = row["DatasetCode"]
-        description_part = (
-            codes_config[indicatorsetcode].removeprefix("faostat-").replace("-", "_")
+        filename = get_resource_filename(
+            countryiso, get_code_description(codes_config[indicatorsetcode])
         )
-        filename = f"{countryiso.lower()}_faostat_{description_part}.csv"
         shortname = longname.split(": ", 1)[-1]
         description = f"*{shortname}:*\n{row['DatasetDescription']}"
         resourcedata = {"name": filename, "description": description}
-        header_insertions = [(0, "EndDate"), (0, "StartDate"), (0, "Iso3")]
-        headers, iterator = retriever.downloader.get_tabular_rows(
-            url,
-            dict_form=True,
-            header_insertions=header_insertions,
-            format="csv",
-            encoding="WINDOWS-1252",
-        )
+        resource_dir = row.get("resource_dir")
+        if resource_dir:
+            # The resource file was written when the bulk CSV was fanned out
+            # so it only needs attaching
+            filepath = join(resource_dir, filename)
+            if area is None or not exists(filepath):
+                logger.warning(f"{longname} for {countryname} has no data!")
+                continue
+            # The file also has the rows of any other area codes with this
+            # ISO3 so its period and rows are theirs combined
+            shared = [
+                areas[x]
+                for x, (isolookup, _) in countrymapping.items()
+                if isolookup == countryiso and x in areas
+            ]
+            resource = Resource(resourcedata)
+            resource.set_format("csv")
+            resource.set_file_to_upload(filepath)
+            dataset.add_update_resource(resource)
+            dataset.set_time_period(
+                min(x["startdate"] for x in shared), max(x["enddate"] for x in shared)
+            )
+            metrics.add_rows(
+                "generated", indicatorsetcode, sum(x["rows"] for x in shared)
+            )
+            categories.append(category)
+            continue
+        store_rows = None
+        if split_store:
+            store_rows = get_area_rows(split_store, countrycode)
+            if store_rows is None:
+                logger.warning(f"{longname} for {countryname} has no data!")
+                continue
+        elif split_dir:
+            url = join(
+                split_dir, get_split_filename(countrycode, row.get("split_compressed"))
+            )
+            if not exists(url):
+                logger.warning(f"{longname} for {countryname} has no data!")
+                continue
+        else:
+            url = row["path"]
+        if store_rows:
+            fieldnames, iterator = store_rows
+            headers = ["Iso3", "StartDate", "EndDate"] + fieldnames
+        elif split_dir and local_reader:
+            headers, iterator = read_split_rows(url)
+        else:
+            header_insertions = [(0, "EndDate"), (0, "StartDate"), (0, "Iso3")]
+            headers, iterator = retriever.downloader.get_tabular_rows(
+                url,
+                dict_form=True,
+                header_insertions=header_insertions,
+                format="csv",
+                encoding="WINDOWS-1252",
+            )
         success, results = dataset.generate_resource(
             folder,
             filename,
@@ -286,6 +1273,8 @@ def generate_dataset_and_showcase(
         if success is False:
             logger.warning(f"{category} for {countryname} has no data!")
             continue
+        metrics.add_rows("generated", indicatorsetcode, len(results["rows"]))
+        metrics.add("bytes_written", getsize(join(folder, filename)))
         categories.append(category)
 
     if dataset.number_of_resources() == 0:
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+"""
+Profiling:
+----------
+
+Profiles the stages of a run with cProfile and tracemalloc when switched on.
+Each call of a stage is profiled in the thread that runs it and the profiles
+of all calls of a stage are added together. The memory allocated by the first
+calls of each stage is compared with that allocated before them so the
+allocation report of a stage shows which lines allocated the most over those
+calls (including anything allocated by other threads at the same time). Only
+the first calls are compared as each comparison snapshots every allocation. On
+closing, each stage's profile is dumped to <stage>.prof, which can be read with
+pstats or snakeviz, and its allocations to <stage>_allocations.txt.
+
+"""
+
+import cProfile
+import logging
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from os import makedirs
+from os.path import join
+
+from .metrics import format_bytes
+
+logger = logging.getLogger(__name__)
+
+ignored_files = {cProfile.__file__, pstats.__file__, tracemalloc.__file__}
+
+
+class Profiler:
+    """Profile stages of a run, saving the results in folder on exit. A stage
+    called while another is being profiled in the same thread is included in
+    the other's profile. From Python 3.12, only one thread can be profiled at
+    once so a stage called while another thread is being profiled is only
+    counted.
+
+    Args:
+        folder: Folder in which to save profiles and allocation reports
+        top: Number of lines allocating the most to report per stage. Defaults to 20.
+        snapshot_calls: Number of calls of each stage whose allocations are compared. Defaults to 3.
+    """
+
+    def __init__(self, folder, top=20, snapshot_calls=3):
+        self.folder = folder
+        self.top = top
+        self.snapshot_calls = snapshot_calls
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stats = {}
+        self.allocations = {}
+        self.calls = {}
+        self.snapshots = {}
+        self.started_tracemalloc = False
+
+    def __enter__(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.save()
+        finally:
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name):
+        if getattr(self.local, "active", False):
+            yield
+            return
+        self.local.active = True
+        with self.lock:
+            snapshots = self.snapshots.get(name, 0)
+            compare = snapshots < self.snapshot_calls
+            if compare:
+                self.snapshots[name] = snapshots + 1
+        try:
+            if compare:
+                before = tracemalloc.take_snapshot()
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another thread is being profiled
+                profile = None
+            try:
+                yield
+            finally:
+                if profile is not None:
+                    profile.disable()
+                if compare:
+                    differences = tracemalloc.take_snapshot().compare_to(
+                        before, "lineno"
+                    )
+                else:
+                    differences = []
+                self.add(name, profile, differences)
+        finally:
+            self.local.active = False
+
+    def add(self, name, profile, differences):
+        with self.lock:
+            calls = self.calls.setdefault(name, {"profiled": 0, "unprofiled": 0})
+            if profile is None:
+                calls["unprofiled"] += 1
+            else:
+                calls["profiled"] += 1
+                stats = self.stats.get(name)
+                if stats is None:
+                    self.stats[name] = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            allocations = self.allocations.setdefault(name, {})
+            for difference in differences:
+                if not difference.size_diff and not difference.count_diff:
+                    continue
+                frame = difference.traceback[0]
+                if frame.filename in ignored_files:
+                    # Allocated by profiling
+                    continue
+                location = str(frame)
+                allocation = allocations.setdefault(location, [0, 0])
+                allocation[0] += difference.size_diff
+                allocation[1] += difference.count_diff
+
+    def get_allocations_report(self, name):
+        calls = self.calls[name]
+        allocations = sorted(
+            self.allocations[name].items(), key=lambda x: x[1][0], reverse=True
+        )
+        lines = [
+            f"Top {self.top} lines by memory allocated and not freed in {name} over "
+            f"{self.snapshots.get(name, 0)} calls "
+            f"({calls['profiled']} calls profiled, {calls['unprofiled']} not)",
+            "",
+        ]
+        for location, (size, count) in allocations[: self.top]:
+            lines.append(f"{format_bytes(size):>10} {count:>9} blocks  {location}")
+        return "\n".join(lines) + "\n"
+
+    def save(self):
+        makedirs(self.folder, exist_ok=True)
+        with self.lock:
+            for name in self.calls:
+                stats = self.stats.get(name)
+                if stats is not None:
+                    stats.dump_stats(join(self.folder, f"{name}.prof"))
+                with open(join(self.folder, f"{name}_allocations.txt"), "w") as f:
+                    f.write(self.get_allocations_report(name))
+        logger.info(f"Saved profiles of {', '.join(self.calls)} to {self.folder}.")
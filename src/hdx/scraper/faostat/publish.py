@@ -0,0 +1,205 @@
+#!/usr/bin/python
+"""
+Publish:
+--------
+
+Publishes datasets and showcases to HDX from a pool of threads. Every call to
+HDX goes through a global requests per second limiter and is retried with
+exponential backoff on rate limiting and server errors. Progress is stored in
+the same form as progress_storing_folder so that runs can be resumed.
+
+"""
+
+import logging
+import re
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from threading import Lock
+from time import monotonic, perf_counter, sleep
+
+from hdx.utilities.saver import save_text
+
+from .metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+retry_statuses = {429, 500, 502, 503, 504}
+# CKAN API errors that are not recognised have a message of the form
+# ['url', status, 'response']
+_status_regex = re.compile(r"^\['[^']*', (\d{3}), ")
+
+
+def get_retry_status(error):
+    while error is not None:
+        match = _status_regex.match(str(error))
+        if match:
+            status = int(match.group(1))
+            if status in retry_statuses:
+                return status
+            return None
+        if isinstance(error, (ConnectionError, TimeoutError)):
+            return 0
+        error = error.__cause__ or error.__context__
+    return None
+
+
+class RateLimiter:
+    """Limit calls across all threads to rate per second.
+
+    Args:
+        rate: Calls per second. Defaults to None (no limit).
+    """
+
+    def __init__(self, rate=None):
+        if rate:
+            self.interval = 1 / rate
+        else:
+            self.interval = 0
+        self.lock = Lock()
+        self.next_call = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = monotonic()
+            call_at = max(now, self.next_call)
+            self.next_call = call_at + self.interval
+        if call_at > now:
+            sleep(call_at - now)
+
+
+class Publisher:
+    """Run publishing functions in a pool of workers threads while the main
+    thread carries on generating datasets. Whilst in use, the configuration's
+    calls to HDX are rate limited and retried. start must be called in the
+    main thread for each item (eg. country) before submitting its publishing
+    functions. The progress file in info's folder always holds the oldest
+    item that has not been fully published.
+
+    Args:
+        configuration: HDX configuration
+        info: Dictionary containing folder in which to store progress
+        key: Key under which progress is stored eg. iso3
+        workers: Number of worker threads. Defaults to 1.
+        rate: HDX calls per second. Defaults to None (no limit).
+        retries: Number of times to retry a call. Defaults to 5.
+        backoff: Seconds to wait before the first retry, doubling each time. Defaults to 1.
+        metrics: Metrics in which to record latency of HDX calls. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        configuration,
+        info,
+        key,
+        workers=1,
+        rate=None,
+        retries=5,
+        backoff=1.0,
+        metrics=None,
+    ):
+        self.configuration = configuration
+        self.progress_file = Path(info["folder"]) / "progress.txt"
+        self.key = key
+        self.workers = max(workers, 1)
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        # (value, futures) of each item started, oldest first. The same value
+        # may be started more than once (eg. two area codes with one ISO3).
+        self.pending = deque()
+        self.progress = None
+        self.executor = None
+        self.call_remoteckan = None
+
+    def __enter__(self):
+        self.call_remoteckan = self.configuration.call_remoteckan
+        self.configuration.call_remoteckan = self.limited_call_remoteckan
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="faostat-publish"
+        )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.executor.shutdown(wait=True, cancel_futures=exc_type is not None)
+        finally:
+            self.configuration.call_remoteckan = self.call_remoteckan
+        if exc_type is None:
+            self.checkpoint()
+
+    def limited_call_remoteckan(self, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.limiter.wait()
+            start = perf_counter()
+            try:
+                result = self.call_remoteckan(*args, **kwargs)
+            except Exception as e:
+                self.metrics.add_latency(args[0], perf_counter() - start)
+                status = get_retry_status(e)
+                if status is None or attempt >= self.retries:
+                    raise
+                delay = self.backoff * 2**attempt
+                attempt += 1
+                self.metrics.add("hdx_retries")
+                logger.warning(
+                    f"HDX call {args[0]} failed ({status or 'connection error'}). Retry {attempt} in {delay} seconds."
+                )
+                sleep(delay)
+                # Files to upload must be reread from the start
+                for file in kwargs.get("files", {}).values():
+                    file.seek(0)
+                continue
+            self.metrics.add_latency(args[0], perf_counter() - start)
+            return result
+
+    def start(self, value):
+        # progress_storing_folder will have just stored value as the progress
+        # so it must be overwritten if earlier items are still publishing
+        self.pending.append((value, []))
+        self.progress = None
+        self.checkpoint()
+
+    def submit(self, function, *args, **kwargs):
+        # Keep at most twice as many publishing jobs as workers outstanding
+        while True:
+            outstanding = [
+                x for _, futures in self.pending for x in futures if not x.done()
+            ]
+            if len(outstanding) < self.workers * 2:
+                break
+            wait(outstanding, return_when=FIRST_COMPLETED)
+            self.checkpoint()
+        future = self.executor.submit(function, *args, **kwargs)
+        self.pending[-1][1].append(future)
+
+    def wait(self):
+        # Waits for everything submitted so far to be published
+        wait([x for _, futures in self.pending for x in futures])
+        self.checkpoint()
+
+    def checkpoint(self):
+        for _, futures in self.pending:
+            for future in futures:
+                if future.done():
+                    # Raises any exception from publishing
+                    future.result()
+        while self.pending:
+            _, futures = self.pending[0]
+            if not all(x.done() for x in futures):
+                break
+            if len(self.pending) == 1:
+                # The item may still be having publishing functions submitted
+                break
+            self.pending.popleft()
+        if self.pending:
+            progress = f"{self.key}={self.pending[0][0]}"
+            if progress != self.progress:
+                save_text(progress, self.progress_file)
+                self.progress = progress
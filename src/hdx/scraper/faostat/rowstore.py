@@ -0,0 +1,160 @@
+#!/usr/bin/python
+"""
+Row store:
+----------
+
+Alternative to one split file per area code. All the rows of a bulk CSV are
+kept in a single CSV file grouped by area code, alongside a JSON index giving
+the byte range and row count of each area. Readers read an area's rows line
+by line through mmap so that only the line being read is held in memory.
+
+"""
+
+import csv
+import json
+import logging
+from functools import lru_cache
+from mmap import ACCESS_READ, mmap
+from os import rename, stat, unlink
+
+from .splitwriter import SplitWriter, default_buffer_size
+
+logger = logging.getLogger(__name__)
+
+store_filename = "store.csv"
+
+
+def get_index_path(store_path):
+    return f"{store_path.removesuffix('.csv')}.json"
+
+
+class RowStoreWriter(SplitWriter):
+    """Write encoded rows to a row store at store_path. Buffers are appended
+    to a spool file as they are flushed. On closing, the spool is rewritten
+    so that each area's rows are contiguous (unless they already are) and the
+    index is written.
+
+    Args:
+        store_path: Path of row store file
+        header: Encoded header line written at the start of the store
+        buffer_size: Bytes to buffer before writing. Defaults to 64MB.
+    """
+
+    def __init__(self, store_path, header, buffer_size=default_buffer_size, **kwargs):
+        super().__init__(None, header, buffer_size)
+        self.store_path = store_path
+        self.spool_path = f"{store_path}.spool"
+        self.spool = open(self.spool_path, "wb")
+        self.spool.write(header)
+        self.offset = len(header)
+        self.segments = {}
+        self.rows = {}
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.spool.close()
+            unlink(self.spool_path)
+
+    def write(self, area_code, data):
+        self.rows[area_code] = self.rows.get(area_code, 0) + 1
+        super().write(area_code, data)
+
+    def write_buffer(self, area_code, buffer):
+        self.spool.write(buffer)
+        length = len(buffer)
+        segments = self.segments.get(area_code)
+        if segments is None:
+            segments = []
+            self.segments[area_code] = segments
+        segments.append((self.offset, length))
+        self.offset += length
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.spool.close()
+        areas = {}
+        if all(len(x) == 1 for x in self.segments.values()):
+            for area_code, [(offset, length)] in self.segments.items():
+                areas[area_code] = [offset, length, self.rows[area_code]]
+            rename(self.spool_path, self.store_path)
+        else:
+            offset = len(self.header)
+            with open(self.spool_path, "rb") as f, open(self.store_path, "wb") as out:
+                out.write(self.header)
+                with mmap(f.fileno(), 0, access=ACCESS_READ) as spool:
+                    for area_code, segments in self.segments.items():
+                        start = offset
+                        for segment_offset, length in segments:
+                            out.write(spool[segment_offset : segment_offset + length])
+                            offset += length
+                        areas[area_code] = [start, offset - start, self.rows[area_code]]
+            unlink(self.spool_path)
+        index = {"header": [0, len(self.header)], "areas": areas}
+        with open(get_index_path(self.store_path), "w") as f:
+            json.dump(index, f)
+
+
+@lru_cache(maxsize=64)
+def _read_index(index_path, mtime_ns, size):
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def read_index(store_path):
+    """Read the index of a row store. Indexes are cached per process and read
+    again only if the index file has changed. The returned index must not be
+    modified.
+
+    Args:
+        store_path: Path of row store file
+
+    Returns:
+        Index of row store
+    """
+    index_path = get_index_path(store_path)
+    stats = stat(index_path)
+    return _read_index(index_path, stats.st_mtime_ns, stats.st_size)
+
+
+def _read_lines(store_path, offset, length, encoding):
+    with open(store_path, "rb") as f:
+        with mmap(f.fileno(), 0, access=ACCESS_READ) as store:
+            store.seek(offset)
+            end = offset + length
+            while store.tell() < end:
+                yield store.readline().decode(encoding)
+
+
+def get_area_rows(store_path, area_code, index=None, encoding="WINDOWS-1252"):
+    """Get the headers and an iterator of dictionary rows of an area in a
+    row store, or None if the area has no rows. The store is kept open until
+    the iterator is exhausted or closed.
+
+    Args:
+        store_path: Path of row store file
+        area_code: Area code for which to get rows
+        index: Index of row store. Defaults to None (read from file).
+        encoding: Encoding of row store. Defaults to WINDOWS-1252.
+
+    Returns:
+        (headers, iterator of rows) or None
+    """
+    if index is None:
+        index = read_index(store_path)
+    area = index["areas"].get(area_code)
+    if area is None:
+        return None
+    header_offset, header_length = index["header"]
+    offset, length, _ = area
+    with open(store_path, "rb") as f:
+        f.seek(header_offset)
+        header = f.read(header_length).decode(encoding)
+    headers = next(csv.reader([header]))
+    reader = csv.DictReader(
+        _read_lines(store_path, offset, length, encoding), fieldnames=headers
+    )
+    return headers, reader
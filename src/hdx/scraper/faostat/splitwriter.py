@@ -0,0 +1,135 @@
+#!/usr/bin/python
+"""
+Split writer:
+-------------
+
+Writes the rows of a bulk CSV out to one file per area code. Rows are
+buffered in memory per area and flushed in large sequential writes through a
+capped pool of open file handles. Files can be gzip compressed, each write
+appending a gzip member, which gzip readers decompress as one stream.
+
+"""
+
+import gzip
+import logging
+from collections import OrderedDict
+from os.path import join
+
+logger = logging.getLogger(__name__)
+
+default_buffer_size = 64 * 1024 * 1024
+default_max_handles = 64
+# Fastest level as the files are only read back once
+compresslevel = 1
+
+
+def get_split_filename(area_code, compress=False):
+    if compress:
+        return f"{area_code}.csv.gz"
+    return f"{area_code}.csv"
+
+
+class SplitWriter:
+    """Write encoded rows to one file per area code in split_dir. Rows are
+    held in memory until more than buffer_size bytes are buffered across all
+    areas, when the largest buffers are written out until at most half the
+    budget is in use. No more than max_handles files are open at once, the
+    least recently used being closed first. Every file starts with header.
+    Files are named after their area code unless filenames are given. If
+    compress is True, files are gzip compressed.
+
+    Args:
+        split_dir: Folder in which to write files
+        header: Encoded header line written at the start of every file
+        buffer_size: Bytes to buffer before writing. Defaults to 64MB.
+        max_handles: Maximum number of open files. Defaults to 64.
+        filenames: Dictionary of area code to filename. Defaults to None.
+        compress: Whether to gzip compress files. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        split_dir,
+        header,
+        buffer_size=default_buffer_size,
+        max_handles=default_max_handles,
+        filenames=None,
+        compress=False,
+    ):
+        self.split_dir = split_dir
+        self.header = header
+        self.buffer_size = buffer_size
+        self.max_handles = max(max_handles, 1)
+        self.filenames = filenames
+        self.compress = compress
+        self.buffers = {}
+        self.buffered = 0
+        self.handles = OrderedDict()
+        self.created = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_path(self, area_code):
+        if self.filenames is not None:
+            return join(self.split_dir, self.filenames[area_code])
+        return join(self.split_dir, get_split_filename(area_code, self.compress))
+
+    def write(self, area_code, data):
+        buffer = self.buffers.get(area_code)
+        if buffer is None:
+            buffer = bytearray()
+            self.buffers[area_code] = buffer
+        buffer += data
+        self.buffered += len(data)
+        if self.buffered > self.buffer_size:
+            self.flush(self.buffer_size // 2)
+
+    def get_handle(self, area_code):
+        fh = self.handles.get(area_code)
+        if fh is not None:
+            self.handles.move_to_end(area_code)
+            return fh
+        if len(self.handles) >= self.max_handles:
+            _, oldest = self.handles.popitem(last=False)
+            oldest.close()
+        if area_code in self.created:
+            fh = open(self.get_path(area_code), "ab")
+        else:
+            fh = open(self.get_path(area_code), "wb")
+            self.write_data(fh, self.header)
+            self.created.add(area_code)
+        self.handles[area_code] = fh
+        return fh
+
+    def flush(self, target=0):
+        for area_code in sorted(
+            self.buffers, key=lambda x: len(self.buffers[x]), reverse=True
+        ):
+            if self.buffered <= target:
+                break
+            buffer = self.buffers[area_code]
+            if not buffer:
+                continue
+            self.write_buffer(area_code, buffer)
+            self.buffered -= len(buffer)
+            buffer.clear()
+
+    def write_data(self, fh, data):
+        if self.compress:
+            data = gzip.compress(data, compresslevel=compresslevel)
+        fh.write(data)
+
+    def write_buffer(self, area_code, buffer):
+        self.write_data(self.get_handle(area_code), buffer)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for fh in self.handles.values():
+                fh.close()
+            self.handles.clear()
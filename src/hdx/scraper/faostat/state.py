@@ -0,0 +1,122 @@
+#!/usr/bin/python
+"""
+State:
+------
+
+Persists what was seen of each FAOSTAT bulk zip between runs so that
+unchanged indicator sets are neither downloaded nor split again, and what was
+published to HDX so that unchanged datasets are not published again. A cache
+folder can also hold the indicator sets prepared for sharded runs.
+
+"""
+
+import hashlib
+import json
+import logging
+from os import replace
+from os.path import exists
+
+from hdx.utilities.downloader import DownloadError
+
+logger = logging.getLogger(__name__)
+
+state_filename = "state.json"
+published_filename = "published.json"
+# Indicator sets prepared in a cache folder for sharded runs
+indicatorsets_filename = "indicatorsets.json"
+# Bumped whenever what the split records about each area changes so that
+# cached splits without it are split again
+manifest_version = 2
+
+
+def load_state(path):
+    if not exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path, state):
+    # Write then rename so that a crash never leaves a truncated state file
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    replace(temp_path, path)
+
+
+def get_checksum(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_split_fingerprint(areacodes, split_options, resource_countries=None):
+    # Cached splits can only be reused if they were produced with the same
+    # area codes, split options and countries of resource files
+    if areacodes is not None:
+        areacodes = sorted(areacodes)
+    key = [manifest_version, areacodes, split_options or {}]
+    if resource_countries:
+        key.append(resource_countries)
+    key = json.dumps(key, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def get_cached_entry(state, code, fingerprint):
+    entry = state.get("codes", {}).get(code)
+    if entry is None:
+        return None
+    if entry.get("fingerprint") != fingerprint:
+        return None
+    if not exists(entry["split_dir"]):
+        return None
+    return entry
+
+
+def get_validators(downloader):
+    validators = {}
+    for header in ("ETag", "Last-Modified"):
+        value = downloader.get_header(header)
+        if value:
+            validators[header] = value
+    return validators
+
+
+def is_not_modified(downloader, url, entry):
+    headers = {}
+    etag = entry.get("ETag")
+    if etag:
+        headers["If-None-Match"] = etag
+    last_modified = entry.get("Last-Modified")
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    if not headers:
+        return False
+    try:
+        response = downloader.setup(url, stream=True, headers=headers)
+    except DownloadError:
+        return False
+    status = response.status_code
+    downloader.close_response()
+    return status == 304
+
+
+def get_metadata_hash(metadata):
+    key = json.dumps(metadata, sort_keys=True, default=str)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def get_publish_hashes(dataset, showcase):
+    resources = {}
+    for resource in dataset.get_resources():
+        resources[resource["name"]] = {
+            "metadata": get_metadata_hash(resource.data),
+            "content": get_checksum(resource.get_file_to_upload()),
+        }
+    return {
+        "metadata": get_metadata_hash(dataset.data),
+        "resources": resources,
+        "showcase": get_metadata_hash(showcase.data),
+    }
@@ -0,0 +1,232 @@
+#!/usr/bin/python
+"""
+Zip stream:
+-----------
+
+Reads a member of a zip file from the zip's bytes as they arrive, eg. from an
+HTTP response body, so that it can be split while it is still downloading.
+The local file headers that precede each member's data are parsed in turn,
+the wanted member is inflated as it is read and its CRC checked at its end.
+The central directory at the end of the zip is not needed.
+
+"""
+
+import hashlib
+import logging
+import struct
+import zlib
+from io import RawIOBase
+
+logger = logging.getLogger(__name__)
+
+chunk_size = 1024 * 1024
+local_signature = b"PK\x03\x04"
+descriptor_signature = b"PK\x07\x08"
+central_signature = b"PK\x01\x02"
+# signature, version, flags, method, time, date, crc, compressed size,
+# uncompressed size, filename length, extra field length
+local_header = struct.Struct("<4sHHHHHIIIHH")
+stored = 0
+deflated = 8
+# Flag bits: sizes and CRC follow the data, filename is UTF-8
+has_descriptor = 0x08
+utf8_filename = 0x800
+zip64_marker = 0xFFFFFFFF
+
+
+def _get_zip64_sizes(extra, compressed_size, uncompressed_size):
+    # The zip64 extra field holds 8 byte sizes for those in the header that
+    # are set to the marker, uncompressed size first
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, length = struct.unpack_from("<HH", extra, offset)
+        offset += 4
+        if header_id == 1:
+            position = offset
+            if uncompressed_size == zip64_marker:
+                (uncompressed_size,) = struct.unpack_from("<Q", extra, position)
+                position += 8
+            if compressed_size == zip64_marker:
+                (compressed_size,) = struct.unpack_from("<Q", extra, position)
+            break
+        offset += length
+    return compressed_size, uncompressed_size
+
+
+class ZipStream(RawIOBase):
+    """Read the uncompressed bytes of member from an iterable of the bytes of
+    a zip file. Every byte of the zip that is pulled from chunks is hashed and
+    written to copy if given, and the bytes of member are written to
+    extracted if given. Call drain after reading to pull the rest of the zip
+    so that the checksum and copy are of the whole file. Wrap in a
+    BufferedReader for readline and iteration.
+
+    Args:
+        chunks: Iterable of bytes of zip file
+        member: Name of member to read
+        copy: Binary file to which to write the zip. Defaults to None.
+        extracted: Binary file to which to write member. Defaults to None.
+    """
+
+    def __init__(self, chunks, member, copy=None, extracted=None):
+        super().__init__()
+        self.chunks = iter(chunks)
+        self.member = member
+        self.copy = copy
+        self.extracted = extracted
+        self.sha256 = hashlib.sha256()
+        self.bytes_read = 0
+        self.size = 0
+        self.buffer = bytearray()
+        self.info = None
+        self.decompressor = None
+        self.remaining = 0
+        self.crc = 0
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def pull(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.sha256.update(chunk)
+        self.bytes_read += len(chunk)
+        if self.copy is not None:
+            self.copy.write(chunk)
+        self.buffer += chunk
+        return True
+
+    def take(self, length):
+        while len(self.buffer) < length:
+            if not self.pull():
+                raise ValueError(f"Zip ended while reading {self.member}!")
+        data = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        return data
+
+    def read_header(self):
+        signature = self.take(4)
+        if signature != local_signature:
+            if signature == central_signature:
+                raise ValueError(f"{self.member} not found in zip!")
+            raise ValueError(f"Invalid zip local header before {self.member}!")
+        fields = local_header.unpack(signature + self.take(local_header.size - 4))
+        _, _, flags, method, _, _, crc, compressed_size, uncompressed_size = fields[:9]
+        filename = self.take(fields[9])
+        extra = self.take(fields[10])
+        if flags & utf8_filename:
+            filename = filename.decode("utf-8")
+        else:
+            filename = filename.decode("cp437")
+        zip64 = zip64_marker in (compressed_size, uncompressed_size)
+        if zip64:
+            compressed_size, uncompressed_size = _get_zip64_sizes(
+                extra, compressed_size, uncompressed_size
+            )
+        if method not in (stored, deflated):
+            raise ValueError(f"{filename} has unsupported compression {method}!")
+        if method == stored and flags & has_descriptor:
+            # The end of the data cannot be found without the central directory
+            raise ValueError(f"{filename} is stored with a data descriptor!")
+        return {
+            "filename": filename,
+            "flags": flags,
+            "method": method,
+            "crc": crc,
+            "compressed_size": compressed_size,
+            "zip64": zip64,
+        }
+
+    def read_descriptor(self, info):
+        # The signature is optional
+        crc = self.take(4)
+        if crc == descriptor_signature:
+            crc = self.take(4)
+        if info["zip64"]:
+            self.take(16)
+        else:
+            self.take(8)
+        (info["crc"],) = struct.unpack("<I", crc)
+
+    def start_member(self, info):
+        self.info = info
+        if info["method"] == deflated:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        else:
+            self.remaining = info["compressed_size"]
+
+    def skip_member(self, info):
+        if info["method"] == stored:
+            self.take(info["compressed_size"])
+            return
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        while not decompressor.eof:
+            if not self.buffer and not self.pull():
+                raise ValueError(f"Zip ended while reading {info['filename']}!")
+            decompressor.decompress(bytes(self.buffer))
+            self.buffer = bytearray(decompressor.unused_data)
+        if info["flags"] & has_descriptor:
+            self.read_descriptor(info)
+
+    def find_member(self):
+        while True:
+            info = self.read_header()
+            if info["filename"] == self.member:
+                self.start_member(info)
+                return
+            self.skip_member(info)
+
+    def end_member(self):
+        info = self.info
+        if info["flags"] & has_descriptor:
+            self.read_descriptor(info)
+        if self.crc != info["crc"]:
+            raise ValueError(f"Bad CRC for {self.member} in zip!")
+        self.finished = True
+
+    def inflate(self, length):
+        if self.info["method"] == stored:
+            if not self.remaining:
+                return b""
+            if not self.buffer and not self.pull():
+                raise ValueError(f"Zip ended while reading {self.member}!")
+            data = self.take(min(length, self.remaining, len(self.buffer)))
+            self.remaining -= len(data)
+            return data
+        decompressor = self.decompressor
+        while not decompressor.eof:
+            if not self.buffer and not self.pull():
+                raise ValueError(f"Zip ended while reading {self.member}!")
+            data = decompressor.decompress(bytes(self.buffer), length)
+            self.buffer = bytearray(decompressor.unconsumed_tail)
+            if decompressor.eof:
+                self.buffer = bytearray(decompressor.unused_data)
+            if data:
+                return data
+        return b""
+
+    def readinto(self, b):
+        if self.finished:
+            return 0
+        if self.info is None:
+            self.find_member()
+        data = self.inflate(len(b))
+        if not data:
+            self.end_member()
+            return 0
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if self.extracted is not None:
+            self.extracted.write(data)
+        b[: len(data)] = data
+        return len(data)
+
+    def drain(self):
+        while self.pull():
+            self.buffer.clear()
+        self.buffer.clear()
+
+    def get_checksum(self):
+        return self.sha256.hexdigest()
@@ -5,27 +5,62 @@ Unit tests for FAOSTAT.
 """
 
 import csv
+import filecmp
+import gzip
+import hashlib
+import io
+import json
 import logging
+import pstats
 import shutil
-from os.path import basename, join
+from copy import deepcopy
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from os import listdir, makedirs
+from os.path import basename, exists, getsize, join
 from pathlib import Path
+from threading import Event, Thread
+from time import monotonic, sleep
+from zipfile import ZIP_DEFLATED, ZipFile
 
 import pytest
+from ckanapi.errors import NotFound
 from hdx.api.configuration import Configuration
 from hdx.api.locations import Locations
 from hdx.data.vocabulary import Vocabulary
 from hdx.location.country import Country
 from hdx.utilities.compare import assert_files_same
-from hdx.utilities.downloader import DownloadError
+from hdx.utilities.downloader import Download, DownloadError
 from hdx.utilities.path import temp_dir
 from hdx.utilities.retriever import Retrieve
+from hdx.utilities.useragent import UserAgent
 
+from benchmarks.generate import get_areas, month_names, write_bulk_csv
+from benchmarks.run import compare_results
+from hdx.scraper.faostat.__main__ import main
+from hdx.scraper.faostat.generate import Generator
+from hdx.scraper.faostat.metrics import Metrics, get_disk_usage
+from hdx.scraper.faostat.offline import RecordingHDX
 from hdx.scraper.faostat.pipeline import (
     download_indicatorsets,
+    fan_out_zip_member_by_country,
     generate_dataset_and_showcase,
+    get_code_filters,
     get_countries,
+    get_date_range,
+    get_latest_dates,
+    get_shard_countries,
     log_latest_dates,
+    read_split_rows,
+    split_csv_by_country,
+    split_zip_member_by_country,
 )
+from hdx.scraper.faostat.profiling import Profiler
+from hdx.scraper.faostat.publish import Publisher
+from hdx.scraper.faostat.rowstore import get_area_rows, read_index
+from hdx.scraper.faostat.splitwriter import SplitWriter
+from hdx.scraper.faostat.state import get_checksum, get_publish_hashes
+from hdx.scraper.faostat.zipstream import ZipStream
 
 
 class TestFaostat:
@@ -36,6 +71,12 @@ class TestFaostat:
         "origname": "Afghanistan",
     }
     countrymapping = {"2": ("AFG", "Afghanistan")}
+    area = {
+        "rows": 306,
+        "latest": [2018, None],
+        "startdate": "1999-01-01",
+        "enddate": "2018-12-31",
+    }
     fsurl = "https://lala/Food_Security_Data_E_All_Data_(Normalized).zip"
     indicatorsets = {
         "Food Security and Nutrition": [
@@ -100,13 +141,18 @@ class TestFaostat:
     @pytest.fixture(scope="function")
     def retriever(self):
         class MockDownloader:
+            @staticmethod
+            def get_header(header):
+                return None
+
             @staticmethod
             def download_json(url, **kwargs):
+                # Copied as download_indicatorsets adds to the rows
                 return {
                     "Datasets": {
-                        "Dataset": TestFaostat.indicatorsets[
-                            "Food Security and Nutrition"
-                        ]
+                        "Dataset": deepcopy(
+                            TestFaostat.indicatorsets["Food Security and Nutrition"]
+                        )
                     }
                 }
 
@@ -208,6 +254,35 @@ class TestFaostat:
                 use_saved=False,
             )
 
+    @pytest.fixture(scope="function")
+    def http_server(self, tmp_path):
+        www = tmp_path / "www"
+        www.mkdir()
+        shutil.copyfile(
+            join("tests", "fixtures", "FS.zip"),
+            www / "Food_Security_Data_E_All_Data_(Normalized).zip",
+        )
+        responses = []
+
+        class Handler(SimpleHTTPRequestHandler):
+            def send_response(self, code, message=None):
+                responses.append((self.path, code))
+                super().send_response(code, message)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), partial(Handler, directory=str(www))
+        )
+        thread = Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            yield f"http://127.0.0.1:{server.server_port}", www, responses
+        finally:
+            server.shutdown()
+            server.server_close()
+
     def test_get_countries(self, retriever):
         countries, countrymapping = get_countries("mypath", retriever)
         assert countries == [TestFaostat.country]
@@ -225,6 +300,10 @@ class TestFaostat:
         }
 
         class MockDownloader:
+            @staticmethod
+            def get_header(header):
+                return None
+
             @staticmethod
             def download_json(url, **kwargs):
                 return {
@@ -275,6 +354,747 @@ class TestFaostat:
         assert "FBS" in codes_in_result
         assert "CB" not in codes_in_result
 
+    @pytest.mark.parametrize("prefetch,split_workers", [(0, 1), (2, 1), (1, 2)])
+    def test_download_indicatorsets_pipelined(self, prefetch, split_workers):
+        categories = {
+            "Food Security and Nutrition": {
+                "codes": {"FS": "faostat-food-security-indicators"}
+            },
+            "Prices": {"codes": {"CP": "faostat-consumer-price-indices"}},
+        }
+        datasets = [
+            {
+                "DatasetCode": code,
+                "DatasetName": f"{code} name",
+                "FileLocation": f"https://lala/{code}_E_All_Data_(Normalized).zip",
+            }
+            for code in ("CP", "FS", "XX")
+        ]
+        fs_member = "Food_Security_Data_E_All_Data_(Normalized).csv"
+
+        class MockDownloader:
+            @staticmethod
+            def get_header(header):
+                return None
+
+            @staticmethod
+            def download_json(url, **kwargs):
+                return {"Datasets": {"Dataset": datasets}}
+
+            @staticmethod
+            def download_file(url, path=None, **kwargs):
+                # Each zip holds the FS fixture CSV renamed to the member the
+                # pipeline expects for that code
+                code = basename(path).split(".")[0]
+                with ZipFile(join("tests", "fixtures", "FS.zip")) as src:
+                    data = src.read(fs_member)
+                with ZipFile(path, "w") as dst:
+                    dst.writestr(f"{code}_E_All_Data_(Normalized).csv", data)
+                return path
+
+        with temp_dir("faostat-pipelined") as tmpdir:
+            test_retriever = Retrieve(
+                downloader=MockDownloader(),
+                fallback_dir=tmpdir,
+                saved_dir=tmpdir,
+                temp_dir=tmpdir,
+                save=False,
+                use_saved=False,
+            )
+            metrics = Metrics()
+            indicatorsets = download_indicatorsets(
+                "https://lala/datasets_E.json",
+                categories,
+                test_retriever,
+                tmpdir,
+                prefetch=prefetch,
+                split_workers=split_workers,
+                metrics=metrics,
+            )
+            assert list(indicatorsets) == ["Prices", "Food Security and Nutrition"]
+            report = metrics.get_report()
+            assert report["stages"]["download"]["count"] == 2
+            assert report["stages"]["split"]["count"] == 2
+            with ZipFile(join("tests", "fixtures", "FS.zip")) as z:
+                fs_size = z.getinfo(fs_member).file_size
+            assert report["counters"]["bytes_downloaded"] > 2 * fs_size
+            assert report["counters"]["bytes_extracted"] == 2 * fs_size
+            assert report["counters"]["bytes_written"] > 0
+            assert set(report["rows"]["split"]) == {"CP", "FS"}
+            assert indicatorsets["Prices"][0]["DatasetCode"] == "CP"
+            for rows in indicatorsets.values():
+                split_dir = rows[0]["split_dir"]
+                areas = rows[0]["areas"]
+                assert len(areas) == len(listdir(split_dir))
+                assert areas["2"] == TestFaostat.area
+                assert (Path(split_dir) / "2.csv").exists()
+            assert not (Path(tmpdir) / "CP.zip").exists()
+            assert not (Path(tmpdir) / "FS.zip").exists()
+
+    def test_download_indicatorsets_pipelined_error(self):
+        class MockDownloader:
+            @staticmethod
+            def get_header(header):
+                return None
+
+            @staticmethod
+            def download_json(url, **kwargs):
+                # Copied as download_indicatorsets adds to the rows
+                return {
+                    "Datasets": {
+                        "Dataset": deepcopy(
+                            TestFaostat.indicatorsets["Food Security and Nutrition"]
+                        )
+                    }
+                }
+
+            @staticmethod
+            def download_file(url, path=None, **kwargs):
+                raise DownloadError("Download failed!")
+
+        with temp_dir("faostat-pipelined-error") as tmpdir:
+            test_retriever = Retrieve(
+                downloader=MockDownloader(),
+                fallback_dir=tmpdir,
+                saved_dir=tmpdir,
+                temp_dir=tmpdir,
+                save=False,
+                use_saved=False,
+            )
+            with pytest.raises(DownloadError):
+                download_indicatorsets(
+                    "https://lala/datasets_E.json",
+                    {"Food Security and Nutrition": {"codes": {"FS": "fs"}}},
+                    test_retriever,
+                    tmpdir,
+                    prefetch=1,
+                )
+
+    def test_download_indicatorsets_pipelined_split_error(self):
+        codes = ("CP", "FS", "QCL")
+
+        class MockDownloader:
+            @staticmethod
+            def get_header(header):
+                return None
+
+            @staticmethod
+            def download_json(url, **kwargs):
+                return {
+                    "Datasets": {
+                        "Dataset": [
+                            {
+                                "DatasetCode": code,
+                                "DatasetName": f"{code} name",
+                                "FileLocation": f"https://lala/{code}.zip",
+                            }
+                            for code in codes
+                        ]
+                    }
+                }
+
+            @staticmethod
+            def download_file(url, path=None, **kwargs):
+                # The zips lack the member the split expects so it fails
+                with ZipFile(path, "w") as dst:
+                    dst.writestr("wrong.csv", "a,b\n")
+                return path
+
+        with temp_dir("faostat-pipelined-split-error") as tmpdir:
+            test_retriever = Retrieve(
+                downloader=MockDownloader(),
+                fallback_dir=tmpdir,
+                saved_dir=tmpdir,
+                temp_dir=tmpdir,
+                save=False,
+                use_saved=False,
+            )
+            with pytest.raises(KeyError):
+                download_indicatorsets(
+                    "https://lala/datasets_E.json",
+                    {"Prices": {"codes": {code: code.lower() for code in codes}}},
+                    test_retriever,
+                    tmpdir,
+                    prefetch=2,
+                )
+            # Zips prefetched after the one whose split failed are deleted
+            assert not (Path(tmpdir) / "FS.zip").exists()
+            assert not (Path(tmpdir) / "QCL.zip").exists()
+
+    def test_download_indicatorsets_incremental(self, tmp_path, http_server):
+        base_url, www, responses = http_server
+        zip_url = f"{base_url}/Food_Security_Data_E_All_Data_(Normalized).zip"
+        categories = {"Food Security and Nutrition": {"codes": {"FS": "fs"}}}
+        cache_dir = str(tmp_path / "cache")
+
+        def run(dateupdate, name, **kwargs):
+            dataset = {
+                "DatasetCode": "FS",
+                "DatasetName": "Food Security and Nutrition: Suite",
+                "DateUpdate": dateupdate,
+                "FileLocation": zip_url,
+            }
+            with open(www / "datasets_E.json", "w") as f:
+                json.dump({"Datasets": {"Dataset": [dataset]}}, f)
+            folder = tmp_path / name
+            folder.mkdir()
+            responses.clear()
+            with Download(user_agent="test") as downloader:
+                test_retriever = Retrieve(
+                    downloader=downloader,
+                    fallback_dir=folder,
+                    saved_dir=folder,
+                    temp_dir=folder,
+                    save=False,
+                    use_saved=False,
+                )
+                indicatorsets = download_indicatorsets(
+                    f"{base_url}/datasets_E.json",
+                    categories,
+                    test_retriever,
+                    folder,
+                    prefetch=0,
+                    areacodes={"2"},
+                    cache_dir=cache_dir,
+                    **kwargs,
+                )
+            zip_responses = [code for path, code in responses if "Food" in path]
+            return indicatorsets["Food Security and Nutrition"][0], zip_responses
+
+        row, zip_responses = run("2024-01-01", "run1")
+        assert zip_responses == [200]
+        assert row["split_dir"] == join(cache_dir, "FS_split")
+        assert row["areas"] == {"2": TestFaostat.area}
+        with open(join(cache_dir, "state.json")) as f:
+            entry = json.load(f)["codes"]["FS"]
+        assert entry["DateUpdate"] == "2024-01-01"
+        assert entry["Last-Modified"]
+        assert len(entry["checksum"]) == 64
+
+        # Unchanged DateUpdate so nothing is downloaded
+        row, zip_responses = run("2024-01-01", "run2")
+        assert zip_responses == []
+        assert row["areas"] == {"2": TestFaostat.area}
+        assert (Path(row["split_dir"]) / "2.csv").exists()
+
+        # Changed DateUpdate but the server says the zip is not modified
+        row, zip_responses = run("2024-02-01", "run3")
+        assert zip_responses == [304]
+        with open(join(cache_dir, "state.json")) as f:
+            assert json.load(f)["codes"]["FS"]["DateUpdate"] == "2024-02-01"
+
+        # Split options that do not apply when fanning out to resource files
+        # do not invalidate the cache
+        resource_countries = {"2": "AFG"}
+        row, zip_responses = run(
+            "2024-02-01",
+            "run4",
+            split_options={"fast": False},
+            resource_countries=resource_countries,
+        )
+        assert zip_responses == [200]
+        row, zip_responses = run(
+            "2024-02-01",
+            "run5",
+            split_options={"fast": True, "compress": True},
+            resource_countries=resource_countries,
+        )
+        assert zip_responses == []
+        assert "split_compressed" not in row
+
+    def test_download_indicatorsets_resume(self, tmp_path, http_server):
+        base_url, www, responses = http_server
+        zip_url = f"{base_url}/Food_Security_Data_E_All_Data_(Normalized).zip"
+        categories = {
+            "Food Security and Nutrition": {"codes": {"FS": "fs", "FT": "ft"}}
+        }
+        datasets = [
+            {
+                "DatasetCode": code,
+                "DatasetName": f"Food Security and Nutrition: {code}",
+                "DateUpdate": "2024-01-01",
+                "FileLocation": zip_url,
+            }
+            for code in ("FS", "FT")
+        ]
+        with open(www / "datasets_E.json", "w") as f:
+            json.dump({"Datasets": {"Dataset": datasets}}, f)
+        # The batch folder is kept when a run fails
+        folder = tmp_path / "batch"
+        folder.mkdir()
+
+        def run():
+            responses.clear()
+            with Download(user_agent="test") as downloader:
+                test_retriever = Retrieve(
+                    downloader=downloader,
+                    fallback_dir=folder,
+                    saved_dir=folder,
+                    temp_dir=folder,
+                    save=False,
+                    use_saved=False,
+                )
+                indicatorsets = download_indicatorsets(
+                    f"{base_url}/datasets_E.json",
+                    categories,
+                    test_retriever,
+                    folder,
+                    prefetch=0,
+                    areacodes={"2"},
+                )
+            zip_responses = [code for path, code in responses if "Food" in path]
+            return indicatorsets["Food Security and Nutrition"], zip_responses
+
+        rows, zip_responses = run()
+        assert zip_responses == [200, 200]
+        state_path = folder / "state.json"
+        with open(state_path) as f:
+            state = json.load(f)
+        assert sorted(state["codes"]) == ["FS", "FT"]
+        entry = state["codes"]["FS"]
+        assert entry["split_dir"] == str(folder / "FS_split")
+        assert len(entry["checksum"]) == 64
+        assert entry["areas"] == {"2": TestFaostat.area}
+
+        # Simulate a run that failed while splitting FT
+        del state["codes"]["FT"]
+        with open(state_path, "w") as f:
+            json.dump(state, f)
+        (folder / "FT_split" / "2.csv").write_text("partial")
+        rows, zip_responses = run()
+        assert zip_responses == [200]
+        assert [row["split_dir"] for row in rows] == [
+            str(folder / "FS_split"),
+            str(folder / "FT_split"),
+        ]
+        assert rows[1]["areas"] == {"2": TestFaostat.area}
+        assert (folder / "FT_split" / "2.csv").read_text() == (
+            folder / "FS_split" / "2.csv"
+        ).read_text()
+        with open(state_path) as f:
+            assert sorted(json.load(f)["codes"]) == ["FS", "FT"]
+
+    @pytest.mark.parametrize("save,split_workers", [(False, 1), (True, 2)])
+    def test_download_indicatorsets_streamed(
+        self, tmp_path, http_server, save, split_workers
+    ):
+        base_url, www, responses = http_server
+        zip_path = join("tests", "fixtures", "FS.zip")
+        member = "Food_Security_Data_E_All_Data_(Normalized).csv"
+        dataset = {
+            "DatasetCode": "FS",
+            "DatasetName": "Food Security and Nutrition: Suite",
+            "DateUpdate": "2024-01-01",
+            "FileLocation": f"{base_url}/{member.replace('csv', 'zip')}",
+        }
+        with open(www / "datasets_E.json", "w") as f:
+            json.dump({"Datasets": {"Dataset": [dataset]}}, f)
+        folder = tmp_path / "folder"
+        folder.mkdir()
+        saved_dir = tmp_path / "saved"
+        saved_dir.mkdir()
+        metrics = Metrics()
+        with Download(user_agent="test") as downloader:
+            test_retriever = Retrieve(
+                downloader=downloader,
+                fallback_dir=folder,
+                saved_dir=saved_dir,
+                temp_dir=folder,
+                save=save,
+                use_saved=False,
+            )
+            indicatorsets = download_indicatorsets(
+                f"{base_url}/datasets_E.json",
+                {"Food Security and Nutrition": {"codes": {"FS": "fs"}}},
+                test_retriever,
+                folder,
+                prefetch=0,
+                split_workers=split_workers,
+                areacodes={"2", "4"},
+                metrics=metrics,
+                stream=True,
+            )
+        row = indicatorsets["Food Security and Nutrition"][0]
+        expected_dir = tmp_path / "expected"
+        expected_dir.mkdir()
+        areas = split_zip_member_by_country(
+            zip_path, member, expected_dir, areacodes={"2", "4"}
+        )
+        assert row["areas"] == areas
+        _, mismatch, errors = filecmp.cmpfiles(
+            expected_dir, row["split_dir"], ["2.csv", "4.csv"], shallow=False
+        )
+        assert mismatch == []
+        assert errors == []
+        with open(folder / "state.json") as f:
+            entry = json.load(f)["codes"]["FS"]
+        assert entry["checksum"] == get_checksum(zip_path)
+        assert entry["Last-Modified"]
+        counters = metrics.get_counts()["counters"]
+        assert counters["bytes_downloaded"] == getsize(zip_path)
+        with ZipFile(zip_path) as z:
+            assert counters["bytes_extracted"] == z.getinfo(member).file_size
+        assert not (folder / "FS.zip").exists()
+        if save:
+            assert filecmp.cmp(saved_dir / "FS.zip", zip_path, shallow=False)
+            with ZipFile(zip_path) as z:
+                assert Path(row["path"]).read_bytes() == z.read(member)
+        else:
+            assert listdir(saved_dir) == []
+            assert "path" not in row
+
+    def test_zip_stream(self):
+        with ZipFile(join("tests", "fixtures", "FS.zip")) as z:
+            data = z.read("Food_Security_Data_E_All_Data_(Normalized).csv")[:100000]
+
+        class Unseekable(io.RawIOBase):
+            # Zips written to unseekable files have data descriptors
+            def __init__(self):
+                self.data = bytearray()
+
+            def writable(self):
+                return True
+
+            def write(self, b):
+                self.data += b
+                return len(b)
+
+        unseekable = Unseekable()
+        with ZipFile(unseekable, "w", compression=ZIP_DEFLATED) as z:
+            z.writestr("Flags.csv", b"Flag\r\n" * 1000)
+            z.writestr("Data.csv", data)
+        seekable = io.BytesIO()
+        with ZipFile(seekable, "w") as z:
+            z.writestr("Flags.csv", b"Flag\r\n" * 1000)
+            z.writestr("Data.csv", data)
+
+        def chunks(zipped, size):
+            return (zipped[i : i + size] for i in range(0, len(zipped), size))
+
+        for zipped in (bytes(unseekable.data), seekable.getvalue()):
+            for size in (13, 100000000):
+                stream = ZipStream(chunks(zipped, size), "Data.csv")
+                assert b"".join(io.BufferedReader(stream)) == data
+                stream.drain()
+                assert stream.bytes_read == len(zipped)
+                assert stream.get_checksum() == hashlib.sha256(zipped).hexdigest()
+        with pytest.raises(ValueError, match="Other.csv not found"):
+            ZipStream([zipped], "Other.csv").read()
+        corrupted = bytearray(zipped)
+        corrupted[zipped.index(b"Data.csv") + 1000] ^= 1
+        with pytest.raises(ValueError, match="Bad CRC"):
+            io.BufferedReader(ZipStream([bytes(corrupted)], "Data.csv")).read()
+
+    def test_split_zip_member_by_country(self, tmp_path):
+        zip_path = join("tests", "fixtures", "FS.zip")
+        member = "Food_Security_Data_E_All_Data_(Normalized).csv"
+        with ZipFile(zip_path, "r") as z:
+            extracted = z.extract(member, path=tmp_path)
+        extracted_dir = tmp_path / "extracted"
+        extracted_dir.mkdir()
+        split_csv_by_country(extracted, extracted_dir)
+        streamed_dir = tmp_path / "streamed"
+        streamed_dir.mkdir()
+        split_zip_member_by_country(zip_path, member, streamed_dir)
+        filenames = sorted(listdir(extracted_dir))
+        assert "2.csv" in filenames
+        assert sorted(listdir(streamed_dir)) == filenames
+        _, mismatch, errors = filecmp.cmpfiles(
+            extracted_dir, streamed_dir, filenames, shallow=False
+        )
+        assert mismatch == []
+        assert errors == []
+
+        bounded_dir = tmp_path / "bounded"
+        bounded_dir.mkdir()
+        split_csv_by_country(extracted, bounded_dir, buffer_size=1000, max_handles=2)
+        _, mismatch, errors = filecmp.cmpfiles(
+            extracted_dir, bounded_dir, filenames, shallow=False
+        )
+        assert mismatch == []
+        assert errors == []
+
+        filtered_dir = tmp_path / "filtered"
+        filtered_dir.mkdir()
+        areas = split_zip_member_by_country(
+            zip_path, member, filtered_dir, areacodes={"2", "4"}
+        )
+        assert areas == {"2": TestFaostat.area, "4": dict(TestFaostat.area, rows=367)}
+        assert sorted(listdir(filtered_dir)) == ["2.csv", "4.csv"]
+        assert filecmp.cmp(extracted_dir / "2.csv", filtered_dir / "2.csv", False)
+
+    @staticmethod
+    def read_split_rows(split_dir):
+        rows = {}
+        for filename in sorted(listdir(split_dir)):
+            with open(
+                join(split_dir, filename), encoding="WINDOWS-1252", newline=""
+            ) as f:
+                rows[filename] = list(csv.DictReader(f))
+        return rows
+
+    def test_split_fast(self, tmp_path):
+        zip_path = join("tests", "fixtures", "FS.zip")
+        member = "Food_Security_Data_E_All_Data_(Normalized).csv"
+        rows_dir = tmp_path / "rows"
+        rows_dir.mkdir()
+        rows_areas = split_zip_member_by_country(zip_path, member, rows_dir)
+        fast_dir = tmp_path / "fast"
+        fast_dir.mkdir()
+        areas = split_zip_member_by_country(zip_path, member, fast_dir, fast=True)
+        assert areas == rows_areas
+        assert self.read_split_rows(fast_dir) == self.read_split_rows(rows_dir)
+        # Lines are copied as they are in the bulk CSV
+        with ZipFile(zip_path, "r") as z:
+            with z.open(member) as f:
+                f.readline()
+                line = f.readline()
+        assert line in (fast_dir / "2.csv").read_bytes()
+
+        # Unquoted, partially quoted, embedded quotes and newlines, and a line
+        # quoted in as many places as one with every field quoted
+        text = (
+            "Area,Value,Area Code\r\n"
+            '"X","1","2"\r\n'
+            '"a",b"c"d,"2"\r\n'
+            "Y,2,3\r\n"
+            "\r\n"
+            '"Z ""q""","multi\r\nline","2"\r\n'
+            '"W","",3\r\n'
+            '"V","4","3"'
+        )
+        filepath = tmp_path / "test.csv"
+        filepath.write_bytes(text.encode("WINDOWS-1252"))
+        rows_dir = tmp_path / "rows2"
+        rows_dir.mkdir()
+        rows_areas = split_csv_by_country(filepath, rows_dir)
+        fast_dir = tmp_path / "fast2"
+        fast_dir.mkdir()
+        areas = split_csv_by_country(filepath, fast_dir, fast=True)
+        assert areas == rows_areas == {"2": {"rows": 3}, "3": {"rows": 3}}
+        assert self.read_split_rows(fast_dir) == self.read_split_rows(rows_dir)
+
+        filepath.write_bytes(b'Area,Area Code\r\n"X","2\r\n')
+        with pytest.raises(ValueError):
+            split_csv_by_country(filepath, tmp_path / "fast2", fast=True)
+
+    def test_split_filters(self, retriever, tmp_path):
+        zip_path = join("tests", "fixtures", "FS.zip")
+        member = "Food_Security_Data_E_All_Data_(Normalized).csv"
+        code_config = {
+            "description": "faostat-food-security-indicators",
+            "items": {"include": [21010, "21011", "22013"]},
+            "elements": {"exclude": [6132]},
+        }
+        filters = get_code_filters(code_config)
+        assert filters == [
+            ["Item Code", ["21010", "21011", "22013"], []],
+            ["Element Code", None, ["6132"]],
+        ]
+        assert get_code_filters("faostat-food-security-indicators") is None
+        with ZipFile(zip_path) as z:
+            with z.open(member) as f:
+                text = io.TextIOWrapper(f, encoding="WINDOWS-1252", newline="")
+                expected = {}
+                for row in csv.DictReader(text):
+                    if row["Item Code"] not in ("21010", "21011", "22013"):
+                        continue
+                    if row["Element Code"] == "6132":
+                        continue
+                    area_code = row["Area Code"]
+                    expected[area_code] = expected.get(area_code, 0) + 1
+        results = {}
+        for fast in (False, True):
+            split_dir = tmp_path / str(fast)
+            split_dir.mkdir()
+            areas = split_zip_member_by_country(
+                zip_path, member, split_dir, fast=fast, filters=filters
+            )
+            assert {x: area["rows"] for x, area in areas.items()} == expected
+            results[fast] = self.read_split_rows(split_dir)
+        assert results[True] == results[False]
+        rows = results[True]["2.csv"]
+        assert {x["Item Code"] for x in rows} == {"21010", "21011", "22013"}
+        resource_dir = tmp_path / "resources"
+        resource_dir.mkdir()
+        areas = fan_out_zip_member_by_country(
+            zip_path,
+            member,
+            resource_dir,
+            {"2": "AFG"},
+            "faostat-food-security-indicators",
+            filters=filters,
+        )
+        assert areas["2"]["rows"] == expected["2"]
+        filepath = tmp_path / "test.csv"
+        filepath.write_bytes(b"Area Code,Value\r\n2,1\r\n")
+        with pytest.raises(ValueError, match="no Element Code column"):
+            split_csv_by_country(
+                filepath, tmp_path, filters=[["Element Code", ["1"], []]]
+            )
+
+        # Splits made without the filters are not reused
+        category = "Food Security and Nutrition"
+        categories = {category: {"codes": {"FS": "faostat-food-security-indicators"}}}
+        cache_dir = tmp_path / "cache"
+        download = partial(
+            download_indicatorsets,
+            "https://lala/datasets_E.json",
+            retriever=retriever,
+            folder=str(tmp_path),
+            cache_dir=str(cache_dir),
+        )
+        indicatorsets = download(categories=categories)
+        assert indicatorsets[category][0]["areas"]["2"]["rows"] == 306
+        categories[category]["codes"]["FS"] = code_config
+        metrics = Metrics()
+        indicatorsets = download(categories=categories, metrics=metrics)
+        assert "codes_reused" not in metrics.get_counts()["counters"]
+        areas = indicatorsets[category][0]["areas"]
+        assert {x: area["rows"] for x, area in areas.items()} == expected
+        metrics = Metrics()
+        download(categories=categories, metrics=metrics)
+        assert metrics.get_counts()["counters"]["codes_reused"] == 1
+
+    def test_benchmark_generator(self, tmp_path):
+        areas = get_areas(3)
+        assert areas[0] == ("1", "Armenia")
+        areas.append(("5000", "Côte d'Ivoire"))
+        csv_path = tmp_path / "FS.csv"
+        write_bulk_csv(csv_path, 1000, areas, months=True, seed=1)
+        with open(csv_path, "rb") as f:
+            header = f.readline()
+            assert header.startswith(b"Area Code,Area,")
+            assert b"Months Code,Months" in header
+            assert f.readline().startswith(b'"1","Armenia","21000"')
+        split_dir = tmp_path / "split"
+        split_dir.mkdir()
+        split = split_csv_by_country(csv_path, split_dir, fast=True)
+        assert list(split) == ["1", "2", "3", "5000"]
+        assert sum(x["rows"] for x in split.values()) == 1000
+        rows = self.read_split_rows(split_dir)["5000.csv"]
+        assert rows[0]["Area"] == "Côte d'Ivoire"
+        assert {x["Months"] for x in rows} <= {"Annual value", *month_names}
+
+        results = {
+            "parameters": {},
+            "stages": {
+                "split": {"seconds": 1.0, "rows_per_second": 700},
+                "quick": {"seconds": 0.001, "rows_per_second": 1},
+            },
+        }
+        baseline = {
+            "parameters": {},
+            "stages": {
+                "split": {"seconds": 0.5, "rows_per_second": 1000},
+                "quick": {"seconds": 0.001, "rows_per_second": 1000},
+            },
+        }
+        assert compare_results(results, baseline) == ["split"]
+        assert compare_results(results, baseline, tolerance=0.5) == []
+
+    def test_split_writer(self, tmp_path):
+        with SplitWriter(tmp_path, b"h\r\n", buffer_size=4, max_handles=1) as writer:
+            writer.write("2", b"a\r\n")
+            writer.write("3", b"b\r\n")
+            writer.write("2", b"c\r\n")
+            assert len(writer.handles) == 1
+        assert (tmp_path / "2.csv").read_bytes() == b"h\r\na\r\nc\r\n"
+        assert (tmp_path / "3.csv").read_bytes() == b"h\r\nb\r\n"
+
+    def test_split_compressed(self, configuration, tmp_path):
+        zip_path = join("tests", "fixtures", "FS.zip")
+        member = "Food_Security_Data_E_All_Data_(Normalized).csv"
+        category = "Food Security and Nutrition"
+        csv_dir = tmp_path / "csv"
+        csv_dir.mkdir()
+        csv_areas = split_zip_member_by_country(zip_path, member, csv_dir)
+        gz_dir = tmp_path / "gz"
+        gz_dir.mkdir()
+        # A small buffer so that files are written as several gzip members
+        areas = split_zip_member_by_country(
+            zip_path, member, gz_dir, buffer_size=1000, compress=True
+        )
+        assert areas == csv_areas
+        assert sorted(listdir(gz_dir)) == sorted(f"{x}.gz" for x in listdir(csv_dir))
+        for filename in listdir(csv_dir):
+            with gzip.open(gz_dir / f"{filename}.gz") as f:
+                assert f.read() == (csv_dir / filename).read_bytes()
+        assert get_disk_usage(gz_dir) * 3 < get_disk_usage(csv_dir)
+
+        resources = []
+        with Download(user_agent="test") as downloader:
+            test_retriever = Retrieve(
+                downloader=downloader,
+                fallback_dir=tmp_path,
+                saved_dir=tmp_path,
+                temp_dir=tmp_path,
+                save=False,
+                use_saved=False,
+            )
+            for split_dir, compressed in ((csv_dir, False), (gz_dir, True)):
+                row = dict(TestFaostat.indicatorsets[category][0])
+                row["split_dir"] = str(split_dir)
+                if compressed:
+                    row["split_compressed"] = True
+                # Split files read with get_tabular_rows and read_split_rows
+                for local_reader in (False, True):
+                    generated_dir = split_dir / f"generated_{local_reader}"
+                    generated_dir.mkdir()
+                    dataset, _ = generate_dataset_and_showcase(
+                        category,
+                        configuration["categories"],
+                        {category: [row]},
+                        TestFaostat.country,
+                        TestFaostat.countrymapping,
+                        configuration["showcase_base_url"],
+                        configuration["filelist_url"],
+                        test_retriever,
+                        generated_dir,
+                        local_reader=local_reader,
+                    )
+                    resource = dataset.get_resources()[0]
+                    resources.append(resource.get_file_to_upload())
+        for resource in resources[1:]:
+            assert filecmp.cmp(resources[0], resource, shallow=False)
+        headers, rows = read_split_rows(str(gz_dir / "2.csv.gz"))
+        assert headers[:4] == ["Iso3", "StartDate", "EndDate", "Area Code"]
+        assert len(list(rows)) == 306
+
+    @pytest.mark.parametrize("buffer_size", [64 * 1024 * 1024, 1000])
+    def test_row_store(self, tmp_path, buffer_size):
+        zip_path = join("tests", "fixtures", "FS.zip")
+        member = "Food_Security_Data_E_All_Data_(Normalized).csv"
+        csv_dir = tmp_path / "csv"
+        csv_dir.mkdir()
+        csv_areas = split_zip_member_by_country(zip_path, member, csv_dir)
+        store_dir = tmp_path / "store"
+        store_dir.mkdir()
+        areas = split_zip_member_by_country(
+            zip_path, member, store_dir, buffer_size=buffer_size, store=True
+        )
+        assert areas == csv_areas
+        assert sorted(listdir(store_dir)) == ["store.csv", "store.json"]
+        store_path = str(store_dir / "store.csv")
+        index = read_index(store_path)
+        assert {k: v[2] for k, v in index["areas"].items()} == {
+            k: v["rows"] for k, v in csv_areas.items()
+        }
+        headers, iterator = get_area_rows(store_path, "2", index)
+        with open(csv_dir / "2.csv", encoding="WINDOWS-1252", newline="") as f:
+            reader = csv.DictReader(f)
+            assert headers == reader.fieldnames
+            assert list(iterator) == list(reader)
+        # The index is only read again when it changes
+        assert read_index(store_path) is index
+        headers, iterator = get_area_rows(store_path, "4")
+        assert sum(1 for _ in iterator) == index["areas"]["4"][2]
+        assert get_area_rows(store_path, "99999") is None
+        split_zip_member_by_country(
+            zip_path, member, store_dir, areacodes={"2"}, store=True
+        )
+        assert list(read_index(store_path)["areas"]) == ["2"]
+
     def test_generate_dataset_and_showcase(self, configuration, retriever):
         with temp_dir("faostat-test") as folder:
             indicatorsets = download_indicatorsets(
@@ -283,7 +1103,13 @@ class TestFaostat:
                 retriever,
                 folder,
             )
-            assert indicatorsets == TestFaostat.indicatorsets
+            row = indicatorsets["Food Security and Nutrition"][0]
+            assert row["split_dir"] == join(folder, "FS_split")
+            assert row["areas"]["2"] == TestFaostat.area
+            assert "path" not in row
+            expected = TestFaostat.indicatorsets["Food Security and Nutrition"][0]
+            assert {k: v for k, v in row.items() if k in expected} == expected
+            assert not (Path(folder) / "FS.csv").exists()
 
             filelist_url = configuration["filelist_url"]
             showcase_base_url = configuration["showcase_base_url"]
@@ -293,7 +1119,7 @@ class TestFaostat:
             ) = generate_dataset_and_showcase(
                 "Food Security and Nutrition",
                 configuration["categories"],
-                TestFaostat.indicatorsets,
+                indicatorsets,
                 TestFaostat.country,
                 TestFaostat.countrymapping,
                 showcase_base_url,
@@ -357,6 +1183,568 @@ production and trade and agri-environmental statistics.""",
             file = "afg_faostat_food_security_indicators.csv"
             assert_files_same(join("tests", "fixtures", file), join(folder, file))
 
+            hashes = get_publish_hashes(dataset, showcase)
+            assert list(hashes["resources"]) == [file]
+            assert get_publish_hashes(dataset, showcase) == hashes
+            with open(join(folder, file), "a") as f:
+                f.write("AFG,2015-01-01,2015-12-31\n")
+            changed = get_publish_hashes(dataset, showcase)
+            assert changed["metadata"] == hashes["metadata"]
+            assert changed["resources"] != hashes["resources"]
+            dataset["notes"] = "Changed"
+            assert (
+                get_publish_hashes(dataset, showcase)["metadata"] != hashes["metadata"]
+            )
+
+    def test_generate_dataset_from_row_store(self, configuration, retriever):
+        with temp_dir("faostat-test-store") as folder:
+            split_dir = join(folder, "FS_split")
+            makedirs(split_dir)
+            split_zip_member_by_country(
+                join("tests", "fixtures", "FS.zip"),
+                "Food_Security_Data_E_All_Data_(Normalized).csv",
+                split_dir,
+                store=True,
+            )
+            row = dict(TestFaostat.indicatorsets["Food Security and Nutrition"][0])
+            row["split_dir"] = split_dir
+            row["split_store"] = join(split_dir, "store.csv")
+            dataset, showcase = generate_dataset_and_showcase(
+                "Food Security and Nutrition",
+                configuration["categories"],
+                {"Food Security and Nutrition": [row]},
+                TestFaostat.country,
+                TestFaostat.countrymapping,
+                configuration["showcase_base_url"],
+                configuration["filelist_url"],
+                retriever,
+                folder,
+            )
+            assert (
+                dataset["dataset_date"]
+                == "[1999-01-01T00:00:00 TO 2018-12-31T23:59:59]"
+            )
+            file = "afg_faostat_food_security_indicators.csv"
+            with open(join(folder, file), encoding="utf-8") as f:
+                rows = list(csv.DictReader(f))
+            assert len(rows) == 306
+            assert rows[0] == {
+                "Iso3": "AFG",
+                "StartDate": "1999-01-01",
+                "EndDate": "2001-12-31",
+                "Area Code": "2",
+                "Area": "Afghanistan",
+                "Item Code": "21010",
+                "Item": "Average dietary energy supply adequacy (percent) (3-year average)",
+                "Element Code": "6121",
+                "Element": "Value",
+                "Year Code": "19992001",
+                "Year": "2001",
+                "Unit": "%",
+                "Value": "89",
+                "Flag": "F",
+            }
+
+    def test_generate_dataset_from_resources(self, configuration, retriever):
+        zip_path = join("tests", "fixtures", "FS.zip")
+        member = "Food_Security_Data_E_All_Data_(Normalized).csv"
+        category = "Food Security and Nutrition"
+        file = "afg_faostat_food_security_indicators.csv"
+        with temp_dir("faostat-test-resources") as folder:
+            # Generated from a row store the usual way to compare with
+            store_dir = join(folder, "store")
+            makedirs(store_dir)
+            split_zip_member_by_country(zip_path, member, store_dir, store=True)
+            row = dict(TestFaostat.indicatorsets[category][0])
+            row["split_dir"] = store_dir
+            row["split_store"] = join(store_dir, "store.csv")
+            generated_dir = join(folder, "generated")
+            makedirs(generated_dir)
+            expected_dataset, _ = generate_dataset_and_showcase(
+                category,
+                configuration["categories"],
+                {category: [row]},
+                TestFaostat.country,
+                TestFaostat.countrymapping,
+                configuration["showcase_base_url"],
+                configuration["filelist_url"],
+                retriever,
+                generated_dir,
+            )
+
+            resource_dir = join(folder, "resources")
+            makedirs(resource_dir)
+            areas = fan_out_zip_member_by_country(
+                zip_path,
+                member,
+                resource_dir,
+                {"2": "AFG", "4": "DZA"},
+                "faostat-food-security-indicators",
+                buffer_size=1000,
+                max_handles=1,
+            )
+            assert areas == {
+                "2": TestFaostat.area,
+                "4": dict(TestFaostat.area, rows=367),
+            }
+            assert sorted(listdir(resource_dir)) == [
+                file,
+                "dza_faostat_food_security_indicators.csv",
+            ]
+            assert filecmp.cmp(
+                join(generated_dir, file), join(resource_dir, file), shallow=False
+            )
+            row = dict(TestFaostat.indicatorsets[category][0])
+            row["split_dir"] = resource_dir
+            row["resource_dir"] = resource_dir
+            row["areas"] = areas
+            dataset, showcase = generate_dataset_and_showcase(
+                category,
+                configuration["categories"],
+                {category: [row]},
+                TestFaostat.country,
+                TestFaostat.countrymapping,
+                configuration["showcase_base_url"],
+                configuration["filelist_url"],
+                retriever,
+                folder,
+            )
+            assert dataset == expected_dataset
+            assert dataset.get_resources() == expected_dataset.get_resources()
+            resource = dataset.get_resources()[0]
+            assert resource.get_file_to_upload() == join(resource_dir, file)
+            assert not exists(join(folder, file))
+
+            # Area codes with the same ISO3 are written to one file
+            shared_dir = join(folder, "shared")
+            makedirs(shared_dir)
+            areas = fan_out_zip_member_by_country(
+                zip_path,
+                member,
+                shared_dir,
+                {"2": "AFG", "4": "AFG"},
+                "faostat-food-security-indicators",
+                buffer_size=1000,
+                max_handles=1,
+            )
+            assert listdir(shared_dir) == [file]
+            with open(join(shared_dir, file), encoding="utf-8", newline="") as f:
+                lines = f.readlines()
+            assert sum(1 for x in lines if x.startswith("Iso3,")) == 1
+            rows = list(csv.DictReader(lines))
+            assert len(rows) == 306 + 367
+            assert {x["Area Code"] for x in rows} == {"2", "4"}
+            assert {x["Iso3"] for x in rows} == {"AFG"}
+            row["resource_dir"] = shared_dir
+            row["areas"] = areas
+            metrics = Metrics()
+            dataset, _ = generate_dataset_and_showcase(
+                category,
+                configuration["categories"],
+                {category: [row]},
+                TestFaostat.country,
+                {"2": ("AFG", "Afghanistan"), "4": ("AFG", "Afghanistan")},
+                configuration["showcase_base_url"],
+                configuration["filelist_url"],
+                retriever,
+                folder,
+                metrics,
+            )
+            resource = dataset.get_resources()[0]
+            assert resource.get_file_to_upload() == join(shared_dir, file)
+            assert metrics.get_report()["rows"]["generated"] == {"FS": 306 + 367}
+
+    def test_generator(self, configuration, retriever):
+        zip_path = join("tests", "fixtures", "FS.zip")
+        member = "Food_Security_Data_E_All_Data_(Normalized).csv"
+        category = "Food Security and Nutrition"
+        Locations.set_validlocations(
+            [
+                {"name": "afg", "title": "Afghanistan"},
+                {"name": "dza", "title": "Algeria"},
+            ]
+        )
+        countries = [
+            TestFaostat.country,
+            {
+                "countrycode": "4",
+                "countryname": "Algeria",
+                "iso3": "DZA",
+                "origname": "Algeria",
+            },
+        ]
+        countrymapping = {"2": ("AFG", "Afghanistan"), "4": ("DZA", "Algeria")}
+        with temp_dir("faostat-test-generator") as folder:
+            store_dir = join(folder, "store")
+            makedirs(store_dir)
+            split_zip_member_by_country(zip_path, member, store_dir, store=True)
+            row = dict(TestFaostat.indicatorsets[category][0])
+            row["split_dir"] = store_dir
+            row["split_store"] = join(store_dir, "store.csv")
+            indicatorsets = {category: [row]}
+            results = {}
+            for workers in (1, 2):
+                generated_dir = join(folder, str(workers))
+                makedirs(generated_dir)
+                metrics = Metrics()
+                with Generator(
+                    configuration,
+                    configuration["categories"],
+                    countrymapping,
+                    configuration["showcase_base_url"],
+                    configuration["filelist_url"],
+                    retriever,
+                    generated_dir,
+                    workers=workers,
+                    metrics=metrics,
+                ) as generator:
+                    for country in countries:
+                        generator.submit(indicatorsets, category, country)
+                    results[workers] = [
+                        generator.get(indicatorsets, category, country)
+                        for country in countries
+                    ]
+                counts = metrics.get_counts()
+                assert counts["rows"] == {"generated": {"FS": 306 + 367}}
+                assert counts["stages"]["generate"]["count"] == 2
+            for (dataset, showcase), (expected_dataset, expected_showcase) in zip(
+                results[2], results[1]
+            ):
+                assert dataset == expected_dataset
+                assert dataset.get_resources() == expected_dataset.get_resources()
+                assert showcase == expected_showcase
+                assert showcase.get_tags() == expected_showcase.get_tags()
+                resource = dataset.get_resources()[0]
+                path = resource.get_file_to_upload()
+                assert Path(path).parent == Path(folder) / "2"
+                expected_path = expected_dataset.get_resources()[0].get_file_to_upload()
+                assert filecmp.cmp(path, expected_path, shallow=False)
+
+    def test_publisher(self, tmp_path):
+        class StubConfiguration:
+            def __init__(self):
+                self.calls = []
+                self.failures = []
+
+            def call_remoteckan(self, action, data, **kwargs):
+                self.calls.append(action)
+                if self.failures:
+                    status = self.failures.pop(0)
+                    raise Exception(
+                        f"['https://hdx/api/action/{action}', {status}, '']"
+                    )
+                return data
+
+        configuration = StubConfiguration()
+        info = {"folder": tmp_path}
+        progress_file = tmp_path / "progress.txt"
+        release = Event()
+
+        def slow_publish():
+            release.wait(5)
+            return configuration.call_remoteckan("package_create", {})
+
+        metrics = Metrics()
+        with Publisher(
+            configuration,
+            info,
+            "iso3",
+            workers=2,
+            rate=100,
+            backoff=0,
+            metrics=metrics,
+        ) as publisher:
+            configuration.failures = [429, 503]
+            assert configuration.call_remoteckan("package_show", {"id": 1}) == {"id": 1}
+            assert configuration.calls == ["package_show"] * 3
+            configuration.failures = [400]
+            with pytest.raises(Exception, match="400"):
+                configuration.call_remoteckan("package_show", {})
+            start = monotonic()
+            for _ in range(10):
+                configuration.call_remoteckan("package_show", {})
+            assert monotonic() - start >= 0.09
+
+            publisher.start("AFG")
+            publisher.submit(slow_publish)
+            publisher.start("AGO")
+            publisher.submit(configuration.call_remoteckan, "showcase_create", {})
+            assert progress_file.read_text() == "iso3=AFG"
+            release.set()
+        assert progress_file.read_text() == "iso3=AGO"
+        assert "package_create" in configuration.calls
+        assert configuration.call_remoteckan.__name__ == "call_remoteckan"
+        report = metrics.get_report()
+        assert report["counters"] == {"hdx_retries": 2}
+        latency = report["hdx_latency"]["package_show"]
+        assert latency["count"] == 14
+        assert sum(latency["buckets"].values()) == 14
+        assert report["hdx_latency"]["package_create"]["count"] == 1
+
+    def test_publisher_repeated_item(self, tmp_path):
+        class StubConfiguration:
+            def call_remoteckan(self, action, data, **kwargs):
+                return data
+
+        release = Event()
+
+        def failing_publish():
+            release.wait(5)
+            raise ValueError("Publish failed!")
+
+        progress_file = tmp_path / "progress.txt"
+        with pytest.raises(ValueError, match="Publish failed"):
+            with Publisher(
+                StubConfiguration(), {"folder": tmp_path}, "iso3"
+            ) as publisher:
+                publisher.start("SDN")
+                publisher.submit(failing_publish)
+                # Area codes sharing an ISO3 start the same value twice
+                publisher.start("SDN")
+                publisher.submit(lambda: None)
+                publisher.start("SYR")
+                assert progress_file.read_text() == "iso3=SDN"
+                release.set()
+                publisher.wait()
+        assert progress_file.read_text() == "iso3=SDN"
+
+    @pytest.fixture(scope="function")
+    def offline_dir(self, configuration, tmp_path, monkeypatch):
+        offline_dir = tmp_path / "saved_data"
+        offline_dir.mkdir()
+        shutil.copyfile(join("tests", "fixtures", "FS.zip"), offline_dir / "FS.zip")
+        with open(offline_dir / "datasets_E.json", "w") as f:
+            json.dump(
+                {
+                    "Datasets": {
+                        "Dataset": TestFaostat.indicatorsets[
+                            "Food Security and Nutrition"
+                        ]
+                    }
+                },
+                f,
+            )
+        category = "Food Security and Nutrition"
+        configuration["categories"] = {category: configuration["categories"][category]}
+        configuration["publish"]["rate"] = None
+        configuration["generate_workers"] = 1
+        monkeypatch.setenv("TEMP_DIR", str(tmp_path / "tmp"))
+        UserAgent.set_global("test")
+        return str(offline_dir)
+
+    @pytest.mark.parametrize("fan_out", [False, True])
+    def test_offline_run(self, configuration, offline_dir, tmp_path, fan_out):
+        configuration["fan_out"] = fan_out
+        metrics_file = tmp_path / "metrics.json"
+        main(offline_dir=offline_dir, metrics_file=str(metrics_file), profile=True)
+        with open(metrics_file) as f:
+            report = json.load(f)
+        with open(tmp_path / "hdx_calls.json") as f:
+            hdx_calls = json.load(f)
+        published = report["counters"]["datasets_published"]
+        assert published > 0
+        counts = hdx_calls["counts"]
+        assert counts["package_create"] == published
+        assert counts["package_revise"] == published
+        assert counts["ckanext_showcase_create"] == published
+        assert counts["ckanext_showcase_package_association_create"] == published
+        assert report["hdx_latency"]["package_create"]["count"] == published
+        uploaded = sum(x["bytes_uploaded"] for x in hdx_calls["calls"])
+        if fan_out:
+            # The resource files are written when the bulk file is split
+            assert uploaded == report["counters"]["bytes_written"]
+        else:
+            assert uploaded > 0
+        profiles = set(listdir(tmp_path / "profile"))
+        for stage in ("countries", "split", "generate", "publish"):
+            assert f"{stage}.prof" in profiles
+            assert f"{stage}_allocations.txt" in profiles
+
+    def test_bounded_disk_run(self, configuration, offline_dir, tmp_path, monkeypatch):
+        configuration["fan_out"] = False
+        # Not in datasets_E.json so there is nothing to generate for it
+        configuration["categories"]["Prices"] = {"codes": {"CP": "cp"}}
+        resource_files = []
+
+        def download(filelist_url, categories, retriever, folder, **kwargs):
+            resource_files.append([x for x in listdir(folder) if x.endswith(".csv")])
+            return download_indicatorsets(
+                filelist_url, categories, retriever, folder, **kwargs
+            )
+
+        monkeypatch.setattr(
+            "hdx.scraper.faostat.__main__.download_indicatorsets", download
+        )
+        metrics_file = tmp_path / "metrics.json"
+        main(offline_dir=offline_dir, metrics_file=str(metrics_file), bounded_disk=True)
+        # The first category's resource files are deleted before the next
+        assert resource_files == [[], []]
+        with open(metrics_file) as f:
+            report = json.load(f)
+        counters = report["counters"]
+        assert counters["datasets_published"] > 0
+        # The splits and resource files are on disk together at the peak
+        assert counters["peak_disk_bytes"] > counters["bytes_written"]
+
+    def test_sharded_run(self, offline_dir, tmp_path):
+        countries = [
+            {"iso3": iso3} for iso3 in ("AFG", "DZA", "YEM", "SDN", "SYR", "UKR")
+        ]
+        shards = [get_shard_countries(countries, x, 3) for x in (1, 2, 3)]
+        assert sorted(x["iso3"] for shard in shards for x in shard) == sorted(
+            x["iso3"] for x in countries
+        )
+        assert get_shard_countries(countries[:3], 2, 3) == [
+            x for x in shards[1] if x in countries[:3]
+        ]
+
+        cache_dir = tmp_path / "cache"
+        with pytest.raises(ValueError, match="cache folder"):
+            main(offline_dir=offline_dir, shard="1/2")
+        with pytest.raises(ValueError, match="form i/N"):
+            main(offline_dir=offline_dir, cache_dir=str(cache_dir), shard="1")
+        with pytest.raises(ValueError, match="from 1/2 to 2/2"):
+            main(offline_dir=offline_dir, cache_dir=str(cache_dir), shard="3/2")
+        with pytest.raises(ValueError, match="--prepare first"):
+            main(offline_dir=offline_dir, cache_dir=str(cache_dir), shard="1/2")
+        main(offline_dir=offline_dir, cache_dir=str(cache_dir), prepare=True)
+        assert exists(cache_dir / "indicatorsets.json")
+        datasets = []
+        for shard in (1, 2):
+            main(offline_dir=offline_dir, cache_dir=str(cache_dir), shard=f"{shard}/2")
+            suffix = f"-shard-{shard}-of-2"
+            with open(cache_dir / f"metrics{suffix}.json") as f:
+                report = json.load(f)
+            # Shards only read the prepared splits
+            assert "split" not in report["stages"]
+            with open(cache_dir / f"published{suffix}.json") as f:
+                published = json.load(f)
+            assert len(published) == report["counters"]["datasets_published"]
+            with open(cache_dir / f"hdx_calls{suffix}.json") as f:
+                hdx_calls = json.load(f)
+            assert hdx_calls["counts"]["package_create"] == len(published)
+            datasets.append(set(published))
+        assert datasets[0] and datasets[1]
+        assert not datasets[0] & datasets[1]
+
+    def test_recording_hdx(self):
+        backend = RecordingHDX(latency=0.01)
+        with pytest.raises(NotFound):
+            backend.call_remoteckan("package_show", {"id": "afg-fs"})
+        created = backend.call_remoteckan(
+            "package_create", {"name": "afg-fs", "resources": [{"name": "a"}]}
+        )
+        start = monotonic()
+        result = backend.call_remoteckan(
+            "package_revise",
+            {
+                "match": json.dumps({"name": "afg-fs"}),
+                "filter": json.dumps(["-resources__1"]),
+                "update": json.dumps({"title": "AFG", "resources": [{"url": "u"}]}),
+            },
+        )
+        assert monotonic() - start >= 0.01
+        package = result["package"]
+        assert package["id"] == created["id"]
+        assert package["title"] == "AFG"
+        resource = package["resources"][0]
+        assert resource["name"] == "a"
+        assert resource["url"] == "u"
+        package["title"] = "Changed"
+        assert (
+            backend.call_remoteckan("package_show", {"id": "afg-fs"})["title"] == "AFG"
+        )
+        assert backend.get_counts() == {
+            "package_show": 2,
+            "package_create": 1,
+            "package_revise": 1,
+        }
+
+    def test_profiler(self, tmp_path):
+        metrics = Metrics()
+        assert metrics.profiler is None
+        with Profiler(tmp_path, top=5, snapshot_calls=2) as profiler:
+            metrics.profiler = profiler
+            for _ in range(3):
+                with metrics.timer("generate"):
+                    with metrics.timer("publish"):
+                        data = [str(x) for x in range(10000)]
+        assert len(data) == 10000
+        assert metrics.get_counts()["stages"]["publish"]["count"] == 3
+        assert sorted(listdir(tmp_path)) == [
+            "generate.prof",
+            "generate_allocations.txt",
+        ]
+        stats = pstats.Stats(str(tmp_path / "generate.prof"))
+        assert any(x[2] == "<listcomp>" for x in stats.stats)
+        report = (tmp_path / "generate_allocations.txt").read_text().splitlines()
+        assert report[0] == (
+            "Top 5 lines by memory allocated and not freed in generate over 2 calls "
+            "(3 calls profiled, 0 not)"
+        )
+        assert len(report) == 7
+        assert any("test_faostat.py" in x for x in report[2:])
+
+    def test_metrics(self, tmp_path):
+        metrics = Metrics()
+        with metrics.timer("download"):
+            pass
+        metrics.add_time("download", 2.0)
+        metrics.add("bytes_downloaded", 3 * 1024 * 1024)
+        metrics.add_rows("split", "FS", 306)
+        metrics.add_rows("split", "FS", 4)
+        metrics.add_latency("package_show", 0.05)
+        metrics.add_latency("package_show", 0.3)
+        metrics.add_latency("package_show", 100)
+        path = tmp_path / "metrics.json"
+        metrics.save(path, "failed")
+        with open(path) as f:
+            report = json.load(f)
+        assert report["status"] == "failed"
+        assert report["stages"]["download"]["count"] == 2
+        assert report["stages"]["download"]["seconds"] >= 2.0
+        assert report["rows"] == {"split": {"FS": 310}}
+        latency = report["hdx_latency"]["package_show"]
+        assert latency["count"] == 3
+        assert latency["max_seconds"] == 100
+        assert latency["buckets"]["0.1"] == 1
+        assert latency["buckets"]["0.5"] == 1
+        assert latency["buckets"]["inf"] == 1
+        assert report["peak_rss_bytes"]["self"] > 0
+        summary = metrics.get_summary()
+        assert summary.startswith("Run completed in ")
+        assert "download 2.0s" in summary
+        assert "3.0 MB downloaded" in summary
+        assert "310 rows split (1 codes)" in summary
+        assert "3 HDX calls (mean 33.45s, max 100.00s)" in summary
+
+        # Files written and deleted between samples are counted
+        disk_dir = tmp_path / "disk"
+        disk_dir.mkdir()
+        with metrics.sample_disk_usage([str(disk_dir)], interval=0.01):
+            (disk_dir / "a").write_bytes(b"x" * 1000)
+            sleep(0.1)
+            (disk_dir / "a").unlink()
+        assert metrics.get_report()["counters"]["peak_disk_bytes"] == 1000
+
+    def test_get_date_range(self):
+        get_date_range.cache_clear()
+        year, startdate, enddate, startdatestr, enddatestr = get_date_range(
+            "1999-2001", None
+        )
+        assert year == "2001"
+        assert startdatestr == "1999-01-01"
+        assert enddatestr == "2001-12-31"
+        assert startdate.year == 1999
+        assert enddate.year == 2001
+        assert get_date_range("2022", "November")[3:] == ("2022-11-01", "2022-11-30")
+        assert get_date_range("2022", "Annual value")[3:] == (
+            "2022-01-01",
+            "2022-12-31",
+        )
+        get_date_range("1999-2001", None)
+        assert get_date_range.cache_info().hits == 1
+
     def test_log_latest_dates(self, tmp_path, caplog):
         csv_path_fs = tmp_path / "FS.csv"
         with open(csv_path_fs, "w", encoding="WINDOWS-1252", newline="") as f:
@@ -405,3 +1793,38 @@ production and trade and agri-environmental statistics.""",
         messages = [r.message for r in caplog.records]
         assert "Latest date for FS: November 2022" in messages
         assert not any("CB" in m for m in messages)
+
+        # The same dates are recorded for each area when splitting
+        for fast in (False, True):
+            split_dir = tmp_path / f"split_{fast}"
+            split_dir.mkdir()
+            areas = split_csv_by_country(csv_path_fs, split_dir, fast=fast)
+            assert areas == {
+                "2": {
+                    "rows": 6,
+                    "latest": [2022, 11],
+                    "startdate": "2020-01-01",
+                    "enddate": "2022-12-31",
+                },
+                "99": {
+                    "rows": 1,
+                    "latest": [2025, None],
+                    "startdate": "2025-01-01",
+                    "enddate": "2025-12-31",
+                },
+            }
+        indicatorsets = {
+            "Food Security": [{"DatasetCode": "FS", "areas": areas}],
+            "Balances": [{"DatasetCode": "CB", "areas": {"99": areas["99"]}}],
+        }
+        assert get_latest_dates(indicatorsets, ["2"]) == {"FS": (2022, 11)}
+        assert get_latest_dates(indicatorsets, ["2", "99"]) == {
+            "FS": (2025, None),
+            "CB": (2025, None),
+        }
+        caplog.clear()
+        with caplog.at_level(logging.INFO, logger="hdx.scraper.faostat.pipeline"):
+            log_latest_dates(indicatorsets, ["2"])
+        assert [r.message for r in caplog.records] == [
+            "Latest date for FS: November 2022"
+        ]